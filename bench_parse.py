@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Бенчмарк парсера учебных планов (courses_parse.parse_pdf_plan).
+#
+#   python bench_parse.py                      # образцы из data/
+#   python bench_parse.py --replicate 10       # + синтетические планы x10 страниц
+#   python bench_parse.py --compare old.json   # сравнить с прошлым прогоном
+
+import time
+import json
+import pathlib
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+
+import pdfplumber
+
+import courses_parse as cp
+
+SAMPLES: List[Tuple[str, pathlib.Path]] = [
+    ("ai",         cp.DATA / "10033-abit.pdf"),
+    ("ai_product", cp.DATA / "10130-abit.pdf"),
+]
+OUT = pathlib.Path("bench_parse.json")
+
+# ---------------------------
+# Подготовка входных данных
+# ---------------------------
+
+def make_synthetic(src: pathlib.Path, n: int, tmpdir: pathlib.Path) -> pathlib.Path:
+    """PDF, в котором все страницы src повторены n раз подряд."""
+    import pypdfium2 as pdfium  # ставится вместе с pdfplumber
+
+    src_doc = pdfium.PdfDocument(src)
+    dst_doc = pdfium.PdfDocument.new()
+    for _ in range(n):
+        dst_doc.import_pages(src_doc)
+    out = tmpdir / f"{src.stem}-x{n}.pdf"
+    dst_doc.save(out)
+    return out
+
+# ---------------------------
+# Замеры
+# ---------------------------
+
+def time_stages(pdf_path: pathlib.Path, program: str) -> Dict[str, float]:
+    """
+    Раскладка времени по стадиям на plumber-пути: раскладка страницы
+    (page.chars), extract_text, extract_tables и регексы/контекст
+    (iter_plan_rows на уже извлечённых страницах). Всегда plumber,
+    независимо от --engine: у chars-движка текст и таблицы не разделены.
+    """
+    t_layout = t_text = t_tables = 0.0
+    pages: List[cp.PageData] = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages:
+            t = time.perf_counter()
+            page.chars
+            t_layout += time.perf_counter() - t
+
+            t = time.perf_counter()
+            text = page.extract_text() or ""
+            t_text += time.perf_counter() - t
+
+            t = time.perf_counter()
+            try:
+                tables = page.extract_tables(cp.TABLE_SETTINGS) or []
+            except Exception:
+                tables = []
+            t_tables += time.perf_counter() - t
+
+            pages.append(([cp.clean(x) for x in text.splitlines() if cp.clean(x)], tables))
+
+    t = time.perf_counter()
+    list(cp.iter_plan_rows(pages, program))
+    t_regex = time.perf_counter() - t
+
+    return {
+        "layout": round(t_layout, 4),
+        "extract_text": round(t_text, 4),
+        "extract_tables": round(t_tables, 4),
+        "regex": round(t_regex, 4),
+    }
+
+def bench_case(pdf_path: pathlib.Path, program: str, repeat: int, dedup: bool = True) -> Dict:
+    """
+    dedup=False — для синтетических планов: их страницы повторяют
+    образец, и со схлопыванием повторов rows считал бы попадания в
+    дедупликацию, а не записи, которые выдал парсер.
+    """
+    cp.configure(dedup=dedup)
+    with pdfplumber.open(pdf_path) as pdf:
+        n_pages = len(pdf.pages)
+
+    # 1) Полный разбор так же, как его делает courses_parse
+    times = []
+    n_rows = 0
+    for _ in range(repeat):
+        t = time.perf_counter()
+        n_rows = len(cp.parse_pdf_plan(pdf_path, program))
+        times.append(time.perf_counter() - t)
+    best = min(times)
+
+    # 2) Пик памяти Python-кучи — отдельным прогоном, tracemalloc замедляет
+    tracemalloc.start()
+    cp.parse_pdf_plan(pdf_path, program)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "file": pdf_path.name,
+        "pages": n_pages,
+        "rows": n_rows,
+        "best_s": round(best, 4),
+        "median_s": round(statistics.median(times), 4),
+        "pages_per_s": round(n_pages / best, 2),
+        "rows_per_s": round(n_rows / best, 2),
+        "dedup": dedup,
+        "stages_s": time_stages(pdf_path, program),
+        "peak_mem_mb": round(peak / 2**20, 2),
+        "rss_mb": round(cp.current_rss_mb(), 1),
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# ---------------------------
+# Вывод
+# ---------------------------
+
+def print_table(cases: Dict[str, Dict]):
+    head = f"{'case':<24}{'pages':>6}{'rows':>6}{'best,s':>9}{'pg/s':>8}{'rows/s':>9}" \
+           f"{'layout':>8}{'text':>8}{'tables':>8}{'regex':>8}{'mem,MB':>8}"
+    print(head)
+    print("-" * len(head))
+    for name, c in cases.items():
+        st = c["stages_s"]
+        print(f"{name:<24}{c['pages']:>6}{c['rows']:>6}{c['best_s']:>9.3f}"
+              f"{c['pages_per_s']:>8.1f}{c['rows_per_s']:>9.1f}"
+              f"{st['layout']:>8.3f}{st['extract_text']:>8.3f}"
+              f"{st['extract_tables']:>8.3f}{st['regex']:>8.3f}{c['peak_mem_mb']:>8.1f}")
+
+def print_compare(cases: Dict[str, Dict], old_path: pathlib.Path):
+    old = json.loads(old_path.read_text("utf-8"))
+    print(f"\nСравнение с {old_path} (commit {old.get('commit')}):")
+    for name, c in cases.items():
+        prev = old.get("cases", {}).get(name)
+        if not prev:
+            print(f"  {name:<24} нет в старом прогоне")
+            continue
+        ratio = c["best_s"] / prev["best_s"] if prev["best_s"] else float("inf")
+        mark = "медленнее" if ratio > 1.05 else "быстрее" if ratio < 0.95 else "≈"
+        print(f"  {name:<24} {prev['best_s']:.3f}s -> {c['best_s']:.3f}s  x{ratio:.2f} {mark}")
+
+# ---------------------------
+# Основной сценарий
+# ---------------------------
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Бенчмарк парсера учебных планов")
+    ap.add_argument("--repeat", type=int, default=3, help="повторов полного разбора на случай")
+    ap.add_argument("--replicate", type=int, default=0, metavar="N",
+                    help="добавить синтетические планы: страницы образца, повторённые N раз")
+    ap.add_argument("--engine", choices=["chars", "plumber"], default=cp.SETTINGS["engine"])
+    ap.add_argument("--out", type=pathlib.Path, default=OUT, help=f"JSON с результатами ({OUT})")
+    ap.add_argument("--compare", type=pathlib.Path, default=None, metavar="OLD_JSON",
+                    help="сравнить с результатами прошлого прогона")
+    args = ap.parse_args(argv)
+    cp.configure(engine=args.engine)
+
+    settings = dict(cp.SETTINGS)
+    cases: Dict[str, Dict] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = [(program, program, path, True) for program, path in SAMPLES]
+        if args.replicate > 1:
+            inputs += [
+                (f"{program}-x{args.replicate}", program,
+                 make_synthetic(path, args.replicate, pathlib.Path(tmp)), False)
+                for program, path in SAMPLES
+            ]
+        for name, program, path, dedup in inputs:
+            print(f"[INFO] bench {name}: {path.name}")
+            cases[name] = bench_case(path, program, args.repeat, dedup)
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pdfplumber": pdfplumber.__version__,
+        "settings": settings,
+        # stages_s всегда снимаются на plumber-пути (см. time_stages)
+        "stages_engine": "plumber",
+        "repeat": args.repeat,
+        "cases": cases,
+    }
+    args.out.write_text(json.dumps(result, ensure_ascii=False, indent=2), "utf-8")
+
+    print()
+    print_table(cases)
+    print("(stages — всегда plumber-путь; синтетические планы — без дедупликации)")
+    if args.compare:
+        print_compare(cases, args.compare)
+    print(f"\nSaved -> {args.out}")
+
+if __name__ == "__main__":
+    main()
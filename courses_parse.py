@@ -2,16 +2,39 @@
 # -*- coding: utf-8 -*-
 # file: parse_study_plan.py
 
+import gc
+import os
 import re
+import sys
+import time
+import bisect
 import json
+import hashlib
 import pathlib
-from typing import List, Dict, Optional
+import sqlite3
+import multiprocessing
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import pdfplumber
+from pdfplumber import utils as plumber_utils
+from pdfplumber.table import TableSettings
 
 DATA = pathlib.Path("data")
 PLAN_INDEX = DATA / "plan_files.json"
 OUT_JSON   = DATA / "courses.json"
+OUT_JSONL  = DATA / "courses.jsonl"
+CACHE_DIR  = DATA / ".cache" / "parse"
+MANIFEST   = DATA / "courses.manifest.json"
+METRICS_JSON = DATA / "parse_metrics.json"
+OUT_DB     = DATA / "courses.db"
+
+# Увеличивать при любом изменении логики разбора, влияющем на результат
+PARSER_VERSION = 1
 
 # ---------------------------
 # Регексы и вспомогательные
@@ -33,6 +56,42 @@ RE_COURSE_LINE  = re.compile(
     re.X
 )
 
+# Шумовые строки (крупные заголовки/итоги блоков), которые не копим в буфер
+NOISE_KEYWORDS = [
+    "блок 1", "блок 2", "блок 3", "блок 4",
+    "модули", "дисциплины", "практика", "аттестация",
+    "универсальная (надпрофессиональная) подготовка",
+    "магистратура/аспирантура", "мировоззренческий модуль",
+    "иностранный язык", "soft skills", "государственная итоговая аттестация",
+]
+# Общие заголовки, случайно попавшие в названия курсов
+HEADER_KEYWORDS = ["учебный план", "блок ", "семестр старт", "лист1"]
+
+def compile_keywords(keywords: List[str]) -> "re.Pattern":
+    """
+    Одна альтернатива из всех ключевых слов (поиск подстроки без учёта
+    регистра) вместо any(kw in line.lower() ...) по списку на каждую строку.
+    """
+    if not keywords:
+        return re.compile(r"(?!)")  # ничего не совпадает
+    alts = sorted({kw.lower() for kw in keywords}, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, alts)), re.I)
+
+# Пересобираются в configure(), если ключевые слова заданы из файла
+RE_NOISE  = compile_keywords(NOISE_KEYWORDS)
+RE_HEADER = compile_keywords(HEADER_KEYWORDS)
+
+def load_keywords(path: pathlib.Path) -> Dict[str, List[str]]:
+    """
+    Ключевые слова из JSON-файла: {"noise": [...], "header": [...]}.
+    Отсутствующий ключ — оставить встроенный список.
+    """
+    data = json.loads(pathlib.Path(path).read_text("utf-8"))
+    unknown = set(data) - {"noise", "header"}
+    if unknown:
+        raise SystemExit(f"{path}: неизвестные ключи {', '.join(sorted(unknown))}")
+    return {f"{k}_keywords": list(v) for k, v in data.items()}
+
 # Иногда названия переносятся. Будем буферить строки,
 # пока не получим хвост "ECTS HOURS".
 def flush_buffer(buf: List[str]) -> Optional[Dict]:
@@ -52,6 +111,10 @@ def flush_buffer(buf: List[str]) -> Optional[Dict]:
     hours = int(m.group("hours"))
     return {"name": name, "ects": ects, "hours": hours}
 
+def is_noise_line(line: str) -> bool:
+    """Шум: крупные заголовки/итоги блоков, не часть названия курса."""
+    return RE_NOISE.search(line) is not None
+
 def clean(text: str) -> str:
     return re.sub(r"\s+", " ", (text or "")).strip()
 
@@ -59,160 +122,1155 @@ def clean(text: str) -> str:
 # Основной разбор PDF
 # ---------------------------
 
-def parse_pdf_plan(pdf_path: pathlib.Path, program: str) -> List[Dict]:
+TABLE_SETTINGS = {
+    "vertical_strategy":   "lines",
+    "horizontal_strategy": "lines",
+    "intersection_tolerance": 5,
+}
+
+# Настройки разбора. Меняются через configure(); в процессы пулов
+# передаются инициализатором (см. make_pool) и входят в отпечаток парсера.
+SETTINGS: Dict = {
+    # Стратегия таблиц lines/lines строит ячейки только по линейкам:
+    # если на странице меньше рёбер (page.edges: линии, стороны
+    # прямоугольников и кривых), таблиц не ищем
+    "table_min_rulings": 1,
+    # chars — символы страницы берутся один раз и общие для текста и таблиц;
+    # plumber — прежний путь через extract_text()/extract_tables()
+    "engine": "chars",
+    # Схлопывать повторы одного курса (текстовый и табличный путь часто
+    # находят одну и ту же строку плана)
+    "dedup": True,
+    # Освобождать кэши объектов каждой страницы сразу после её разбора
+    "low_memory": False,
+    # Предел RSS процесса в МБ: при превышении разбор файла прерывается
+    "max_rss_mb": None,
+    # Ключевые слова фильтров (см. RE_NOISE / RE_HEADER, --keywords)
+    "noise_keywords": NOISE_KEYWORDS,
+    "header_keywords": HEADER_KEYWORDS,
+    # Замеры времени по стадиям (TIMINGS); выключено — накладных расходов нет
+    "metrics": False,
+}
+# Настройки, не влияющие на результат разбора (не входят в отпечаток);
+# engine тоже: оба движка дают одинаковые строки и таблицы
+RUNTIME_SETTINGS = {"engine", "low_memory", "max_rss_mb", "metrics"}
+
+# Счётчики прогона текущего процесса (страницы, пропуски таблиц, ...)
+STATS: Counter = Counter()
+
+def configure(**overrides):
+    global RE_NOISE, RE_HEADER
+    unknown = set(overrides) - set(SETTINGS)
+    if unknown:
+        raise KeyError(f"неизвестные настройки: {', '.join(sorted(unknown))}")
+    SETTINGS.update(overrides)
+    if "noise_keywords" in overrides:
+        RE_NOISE = compile_keywords(SETTINGS["noise_keywords"])
+    if "header_keywords" in overrides:
+        RE_HEADER = compile_keywords(SETTINGS["header_keywords"])
+    parser_fingerprint.cache_clear()
+
+def make_pool(max_workers: int, start_method: Optional[str] = None) -> ProcessPoolExecutor:
+    """
+    Пул процессов с текущими SETTINGS. start_method="spawn" — если
+    рядом живут чужие подпроцессы (драйвер Playwright в pipeline.py):
+    fork унаследовал бы их каналы и не дал бы им завершиться.
+    """
+    ctx = multiprocessing.get_context(start_method) if start_method else None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                               initializer=partial(configure, **SETTINGS))
+
+# ---------------------------
+# Замеры по стадиям
+# ---------------------------
+
+# stage -> секунды / число вызовов (только при SETTINGS["metrics"])
+TIMINGS: Counter = Counter()
+STAGE_CALLS: Counter = Counter()
+_NO_STAGE = nullcontext()
+
+def add_timing(name: str, seconds: float):
+    TIMINGS[name] += seconds
+    STAGE_CALLS[name] += 1
+
+@contextmanager
+def _stage_timer(name: str):
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(name, time.perf_counter() - t)
+
+def stage(name: str):
+    """Контекст-таймер стадии; без metrics — общий пустой контекст."""
+    return _stage_timer(name) if SETTINGS["metrics"] else _NO_STAGE
+
+def timed(name: str, fn: Callable) -> Callable:
+    """
+    Обёртка fn, копящая время в стадии name. Для горячих функций:
+    оборачиваем только при включённых metrics, иначе вызываем fn напрямую.
+    """
+    def wrapper(*args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            add_timing(name, time.perf_counter() - t)
+    return wrapper
+
+def snapshot_metrics() -> Dict:
+    """Счётчики и замеры процесса — для передачи из воркера пула."""
+    return {"stats": dict(STATS), "timings": dict(TIMINGS), "calls": dict(STAGE_CALLS)}
+
+def merge_metrics(snap: Dict):
+    STATS.update(snap["stats"])
+    TIMINGS.update(snap["timings"])
+    STAGE_CALLS.update(snap["calls"])
+
+def reset_metrics():
+    STATS.clear()
+    TIMINGS.clear()
+    STAGE_CALLS.clear()
+
+def metrics_report(wall: float) -> Dict:
+    return {
+        "wall_s": round(wall, 4),
+        "stages": {
+            name: {"seconds": round(sec, 4), "calls": STAGE_CALLS[name]}
+            for name, sec in TIMINGS.most_common()
+        },
+        "counters": dict(STATS),
+    }
+
+def print_metrics(report: Dict):
+    wall = report["wall_s"] or 1e-9
+    print(f"\n{'стадия':<18}{'вызовов':>9}{'сек':>10}{'%':>7}")
+    for name, st in report["stages"].items():
+        print(f"{name:<18}{st['calls']:>9}{st['seconds']:>10.3f}"
+              f"{100 * st['seconds'] / wall:>7.1f}")
+    print(f"{'всего (wall)':<18}{'':>9}{report['wall_s']:>10.3f}")
+    if report["counters"]:
+        print("счётчики: " + ", ".join(f"{k}={v}" for k, v in sorted(report["counters"].items())))
+
+# Сырые данные страницы: строки текста и таблицы (как отдаёт pdfplumber).
+# tables = None — поиск таблиц пропущен (нет линеек).
+PageData = Tuple[List[str], Optional[List[List[List[Optional[str]]]]]]
+
+def has_rulings(page) -> bool:
+    """
+    Дешёвая проверка: есть ли на странице геометрия для lines-стратегии.
+    Считаем page.edges — ровно то, из чего стратегия строит таблицу:
+    помимо линий и прямоугольников это и кривые (сетка, нарисованная
+    ломаными). page.edges кэшируется и потом переиспользуется extract_tables.
+    """
+    return len(page.edges) >= SETTINGS["table_min_rulings"]
+
+def extract_page(page) -> PageData:
+    """
+    Извлекает со страницы всё, что нужно разбору: строки текста и таблицы.
+    Не зависит от соседних страниц, поэтому может выполняться параллельно.
+    """
+    if SETTINGS["engine"] == "chars":
+        return extract_page_chars(page)
+
+    with stage("layout"):
+        page.chars
+    # Сначала пытаемся забрать текст как есть (по строкам)
+    with stage("extract_text"):
+        text = page.extract_text() or ""
+        lines = [clean(x) for x in text.splitlines() if clean(x)]
+
+    # Дополнительно — таблицы.
+    # Некоторые страницы имеют настоящие таблицы; используем edge/lines стратегию.
+    # Это самый дорогой шаг, поэтому страницы без линеек пропускаем.
+    if not has_rulings(page):
+        return lines, None
+    try:
+        with stage("extract_tables"):
+            tables = page.extract_tables(TABLE_SETTINGS) or []
+    except Exception:
+        tables = []
+    return lines, tables
+
+def _char_mids(ch: Dict) -> Tuple[float, float]:
+    return (ch["top"] + ch["bottom"]) / 2, (ch["x0"] + ch["x1"]) / 2
+
+def extract_page_chars(page) -> PageData:
+    """
+    То же, что и plumber-путь, но page.chars обходятся один раз: из них
+    собираются строки текста, а символы таблиц раскладываются по строкам
+    через индекс по вертикальной середине вместо полного перебора на
+    каждую строку таблицы (как делает Table.extract). Результат совпадает.
+    """
+    with stage("layout"):
+        chars = page.chars
+    with stage("extract_text"):
+        text = plumber_utils.chars_to_textmap(
+            chars, layout_bbox=page.bbox,
+            layout_width=page.width, layout_height=page.height,
+        ).as_string
+        lines = [clean(x) for x in text.splitlines() if clean(x)]
+
+    if not has_rulings(page):
+        return lines, None
+    try:
+        with stage("extract_tables"):
+            return lines, _extract_tables_chars(page, chars)
+    except Exception:
+        return lines, []
+
+def _extract_tables_chars(page, chars: List[Dict]) -> List[List[List[Optional[str]]]]:
+    tset = TableSettings.resolve(TABLE_SETTINGS)
+    found = page.find_tables(tset)
+    if not found:
+        return []
+    text_kwargs = tset.text_settings or {}
+
+    mids = [_char_mids(ch) for ch in chars]
+    order = sorted(range(len(chars)), key=lambda i: mids[i][0])
+    v_sorted = [mids[i][0] for i in order]
+
+    tables = []
+    for table in found:
+        arr = []
+        for row in table.rows:
+            x0, top, x1, bottom = row.bbox
+            lo = bisect.bisect_left(v_sorted, top)
+            hi = bisect.bisect_left(v_sorted, bottom)
+            # Исходный порядок символов важен для extract_text
+            row_idx = sorted(i for i in order[lo:hi] if x0 <= mids[i][1] < x1)
+            cells = []
+            for cell in row.cells:
+                if cell is None:
+                    cells.append(None)
+                    continue
+                cx0, ctop, cx1, cbottom = cell
+                cell_chars = [
+                    chars[i] for i in row_idx
+                    if cx0 <= mids[i][1] < cx1 and ctop <= mids[i][0] < cbottom
+                ]
+                cells.append(
+                    plumber_utils.extract_text(cell_chars, **text_kwargs)
+                    if cell_chars else ""
+                )
+            arr.append(cells)
+        tables.append(arr)
+    return tables
+
+def current_rss_mb() -> float:
+    """Текущий RSS процесса, МБ (вне Linux — пиковый из getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def extract_pages(pdf, pdf_path: pathlib.Path, start: int, stop: int) -> Iterator[PageData]:
     """
-    Возвращает список словарей:
+    Извлекает страницы [start, stop) открытого документа.
+    pdfplumber держит кэш объектов каждой прочитанной страницы до закрытия
+    файла; в low_memory-режиме он сбрасывается сразу после разбора страницы.
+    При low_memory/max_rss_mb печатается пиковый RSS за файл (диапазон).
+    """
+    low_mem, limit = SETTINGS["low_memory"], SETTINGS["max_rss_mb"]
+    peak = 0.0
+    for i in range(start, stop):
+        page = pdf.pages[i]
+        data = extract_page(page)
+        if low_mem:
+            page.close()
+        if low_mem or limit:
+            rss = current_rss_mb()
+            if limit and rss > limit:
+                gc.collect()
+                rss = current_rss_mb()
+                if rss > limit:
+                    raise MemoryError(
+                        f"{pdf_path.name}, стр. {i + 1}: RSS {rss:.0f} МБ > --max-rss {limit} МБ"
+                    )
+            peak = max(peak, rss)
+        yield data
+    if low_mem or limit:
+        span = "" if (start, stop) == (0, len(pdf.pages)) else f" [стр. {start + 1}-{stop}]"
+        print(f"[MEM] {pdf_path.name}{span}: пик RSS {peak:.0f} МБ")
+
+def extract_page_range(pdf_path: pathlib.Path, start: int,
+                       stop: int) -> Tuple[List[PageData], Dict]:
+    """
+    Извлекает страницы [start, stop) — единица работы для процесса.
+    Вместе со страницами возвращает замеры процесса (snapshot_metrics).
+    """
+    reset_metrics()
+    with pdfplumber.open(pdf_path) as pdf:
+        pages = list(extract_pages(pdf, pdf_path, start, stop))
+    return pages, snapshot_metrics()
+
+def iter_pages(pdf_path: pathlib.Path, page_jobs: int = 1):
+    """
+    Отдаёт PageData по страницам в исходном порядке.
+    При page_jobs > 1 документ режется на непрерывные диапазоны страниц,
+    которые извлекаются в отдельных процессах.
+    """
+    for data in _iter_pages_raw(pdf_path, page_jobs):
+        STATS["pages"] += 1
+        if data[1] is None:
+            STATS["tables_skipped"] += 1
+        yield data
+
+def _iter_pages_raw(pdf_path: pathlib.Path, page_jobs: int):
+    with pdfplumber.open(pdf_path) as pdf:
+        if page_jobs <= 1:
+            yield from extract_pages(pdf, pdf_path, 0, len(pdf.pages))
+            return
+        n_pages = len(pdf.pages)
+    if n_pages == 0:
+        return  # как и в последовательном режиме — ни одной записи
+
+    chunk = -(-n_pages // page_jobs)  # ceil
+    bounds = [(i, min(i + chunk, n_pages)) for i in range(0, n_pages, chunk)]
+    with make_pool(len(bounds)) as ex:
+        futures = [ex.submit(extract_page_range, pdf_path, a, b) for a, b in bounds]
+        for fut in futures:
+            pages, snap = fut.result()
+            merge_metrics(snap)
+            yield from pages
+
+def is_clean_row(r: Dict) -> bool:
+    """Пост-обработка: отсекает явный мусор (короткие/служебные строки)."""
+    if not r["name"] or len(r["name"]) < 3:
+        return False
+    # отфильтровать общие заголовки, случайно попавшие
+    return RE_HEADER.search(r["name"]) is None
+
+def row_key(r: Dict) -> Tuple:
+    """Нормализованный ключ записи для дедупликации внутри программы."""
+    name = re.sub(r"\s+", " ", r["name"]).strip(" .;—-").lower().replace("ё", "е")
+    return r["semester"], r["type"], name, r["ects"], r["hours"]
+
+def iter_pdf_plan(pdf_path: pathlib.Path, program: str, page_jobs: int = 1) -> Iterator[Dict]:
+    """
+    Генератор очищенных записей курсов, страница за страницей:
     { program, semester, type, name, ects, hours }
+
+    page_jobs > 1 — извлекать страницы параллельно; контекст (семестр, тип
+    блока, буфер переносов) всё равно восстанавливается последовательно,
+    так что результат совпадает с обычным прогоном.
+    """
+    return iter_plan_rows(iter_pages(pdf_path, page_jobs), program)
+
+def update_context(line: str, semester: Optional[int], ctype: str) -> Tuple[Optional[int], str]:
+    """Обновляет контекст по строке: семестр/тип блока."""
+    # Смена типа блока
+    if RE_POOL_ELECT.search(line):
+        ctype = "Выборная"
+        # Заодно вытащим семестр, если он упомянут в этой строке
+        m = RE_SEMESTER_CTX.search(line)
+        if m:
+            semester = int(m.group(1))
+    elif RE_REQUIRED.search(line):
+        # Многие планы внутри "Обязательные дисциплины. 1 семестр ..."
+        ctype = "Обязательная"
+        m = RE_SEMESTER_CTX.search(line)
+        if m:
+            semester = int(m.group(1))
+
+    # Явная смена семестра в любых строках
+    m2 = RE_SEMESTER_CTX.search(line)
+    if m2:
+        semester = int(m2.group(1))
+    return semester, ctype
+
+def table_row_item(row: List[Optional[str]]) -> Optional[Dict]:
+    """
+    Строка таблицы -> {name, ects, hours} либо None.
+    Ищем паттерн "... name ... ects hours": последние две непустые ячейки —
+    числа, остальное — название.
     """
-    results: List[Dict] = []
+    if not row:
+        return None
+    cells = [clean(c) for c in row if clean(c)]
+    if len(cells) < 3:
+        return None
+    try:
+        ects  = int(cells[-2])
+        hours = int(cells[-1])
+    except ValueError:
+        return None
+    name  = " ".join(cells[:-2])
+    # Чистим потенциальный индекс в начале
+    name  = re.sub(r"^\d+\s+", "", name).strip(" .;—-")
+    if name and ects > 0 and hours > 0:
+        return {"name": name, "ects": ects, "hours": hours}
+    return None
+
+def keep_row(r: Dict, seen: set) -> bool:
+    """Пост-обработка и дедупликация (seen — индекс row_key программы)."""
+    if not is_clean_row(r):
+        return False
+    if SETTINGS["dedup"]:
+        key = row_key(r)
+        if key in seen:
+            STATS["duplicates"] += 1
+            return False
+        seen.add(key)
+    return True
 
+def iter_plan_rows(pages: Iterable[PageData], program: str) -> Iterator[Dict]:
+    """
+    Последовательный проход по уже извлечённым страницам: восстанавливает
+    контекст семестра/типа блока, склеивает переносы и отдаёт записи.
+    """
     current_semester: Optional[int] = None
     current_type: str = "Не определено"  # "Обязательная" / "Выборная" / др.
     buf: List[str] = []
+    seen: set = set()  # индекс дедупликации по row_key
+    metrics = SETTINGS["metrics"]
+    # Горячие функции оборачиваем таймером только при включённых замерах
+    flush = timed("flush_buffer", flush_buffer) if metrics else flush_buffer
+    noise = timed("keyword_filter", is_noise_line) if metrics else is_noise_line
 
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            # 1) Сначала пытаемся забрать текст как есть (по строкам)
-            text = page.extract_text() or ""
-            lines = [clean(x) for x in text.splitlines() if clean(x)]
-
+    for lines, tables in pages:
+        t_page = time.perf_counter() if metrics else 0.0
+        STATS["lines"] += len(lines)
+        results: List[Dict] = []  # записи текущей страницы
+        for line in lines:
             # 2) Обновляем контекст: семестр/тип блока
-            for i, line in enumerate(lines):
-                # Смена типа блока
-                if RE_POOL_ELECT.search(line):
-                    current_type = "Выборная"
-                    # Заодно вытащим семестр, если он упомянут в этой строке
-                    m = RE_SEMESTER_CTX.search(line)
-                    if m:
-                        current_semester = int(m.group(1))
-                elif RE_REQUIRED.search(line):
-                    # Многие планы внутри "Обязательные дисциплины. 1 семестр ..."
-                    current_type = "Обязательная"
-                    m = RE_SEMESTER_CTX.search(line)
-                    if m:
-                        current_semester = int(m.group(1))
-
-                # Явная смена семестра в любых строках
-                m2 = RE_SEMESTER_CTX.search(line)
-                if m2:
-                    current_semester = int(m2.group(1))
-
-                # 3) Детект курса: хвост "ECTS HOURS" на строке.
-                #    С учётом переносов — накапливаем в буфер и пытаемся "сбросить".
-                #    Если строка заканчивается "цифры цифры", это сильный признак.
-                if re.search(r"\d+\s+\d+$", line):
-                    buf.append(line)
-                    item = flush_buffer(buf)
-                    if item:
-                        results.append({
-                            "program": program,
-                            "semester": current_semester,
-                            "type": current_type,
-                            **item
-                        })
-                        buf = []
-                    else:
-                        # не получилось — сбрасываем, но без добавления
-                        buf = []
-                else:
-                    # Возможно, это кусок названия с переносом — копим
-                    # Но отбрасываем очевидный шум (крупные заголовки/итоги блоков)
-                    if not any(kw in line.lower() for kw in [
-                        "блок 1", "блок 2", "блок 3", "блок 4",
-                        "модули", "дисциплины", "практика", "аттестация",
-                        "универсальная (надпрофессиональная) подготовка",
-                        "магистратура/аспирантура", "мировоззренческий модуль",
-                        "иностранный язык", "soft skills", "государственная итоговая аттестация"
-                    ]):
-                        buf.append(line)
-
-            # На границе страницы пробуем тоже сбросить буфер (иногда курс кончается на следующей)
-            item = flush_buffer(buf)
-            if item:
-                results.append({
-                    "program": program,
-                    "semester": current_semester,
-                    "type": current_type,
-                    **item
-                })
+            current_semester, current_type = update_context(line, current_semester, current_type)
+
+            # 3) Детект курса: хвост "ECTS HOURS" на строке.
+            #    С учётом переносов — накапливаем в буфер и пытаемся "сбросить".
+            #    Если строка заканчивается "цифры цифры", это сильный признак.
+            if re.search(r"\d+\s+\d+$", line):
+                buf.append(line)
+                item = flush(buf)
+                if item:
+                    results.append({
+                        "program": program,
+                        "semester": current_semester,
+                        "type": current_type,
+                        **item
+                    })
+                # получилось или нет — буфер сбрасываем
                 buf = []
+            else:
+                # Возможно, это кусок названия с переносом — копим
+                # Но отбрасываем очевидный шум (крупные заголовки/итоги блоков)
+                if not noise(line):
+                    buf.append(line)
 
-            # 4) Дополнительная попытка — таблицы.
-            #    Некоторые страницы имеют настоящие таблицы; используем edge/lines стратегию.
-            try:
-                tables = page.extract_tables({
-                    "vertical_strategy":   "lines",
-                    "horizontal_strategy": "lines",
-                    "intersection_tolerance": 5,
-                }) or []
-            except Exception:
-                tables = []
-
-            for tbl in tables:
-                for row in tbl:
-                    if not row: 
-                        continue
-                    cells = [clean(c) for c in row if clean(c)]
-                    if len(cells) < 3:
-                        continue
-                    # Ищем паттерн "... name ... ects hours"
-                    # Берём последние две ячейки как числа, остальное — название.
-                    try:
-                        ects  = int(cells[-2])
-                        hours = int(cells[-1])
-                        name  = " ".join(cells[:-2])
-                        # Чистим потенциальный индекс в начале
-                        name  = re.sub(r"^\d+\s+", "", name).strip(" .;—-")
-                        if name and ects > 0 and hours > 0:
-                            results.append({
-                                "program": program,
-                                "semester": current_semester,
-                                "type": current_type,
-                                "name": name,
-                                "ects": ects,
-                                "hours": hours
-                            })
-                    except Exception:
-                        continue
-
-    # Пост-обработка: уберём явный мусор (короткие/служебные строки)
-    clean_res = []
-    for r in results:
-        if not r["name"] or len(r["name"]) < 3:
+        # На границе страницы пробуем тоже сбросить буфер (иногда курс кончается на следующей)
+        item = flush(buf)
+        if item:
+            results.append({
+                "program": program,
+                "semester": current_semester,
+                "type": current_type,
+                **item
+            })
+            buf = []
+
+        # 4) Дополнительная попытка — строки таблиц страницы.
+        for tbl in tables or []:
+            for row in tbl:
+                item = table_row_item(row)
+                if item:
+                    results.append({
+                        "program": program,
+                        "semester": current_semester,
+                        "type": current_type,
+                        **item
+                    })
+
+        kept = [r for r in results if keep_row(r, seen)]
+        STATS["rows"] += len(kept)
+        if metrics:
+            add_timing("replay", time.perf_counter() - t_page)
+        yield from kept
+
+def parse_pdf_plan(pdf_path: pathlib.Path, program: str, page_jobs: int = 1) -> List[Dict]:
+    """Возвращает список записей плана целиком (см. iter_pdf_plan)."""
+    return list(iter_pdf_plan(pdf_path, program, page_jobs))
+
+
+# ---------------------------
+# Разбор XLSX
+# ---------------------------
+
+XLSX_SUFFIXES = {".xlsx", ".xlsm"}
+
+def _cell_text(v) -> Optional[str]:
+    if v is None:
+        return None
+    if isinstance(v, float) and v.is_integer():
+        v = int(v)  # 3.0 -> "3", иначе int("3.0") в разборе строк таблиц упадёт
+    return str(v)
+
+def iter_xlsx_rows(xlsx_path: pathlib.Path) -> Iterator[List[Optional[str]]]:
+    """
+    Строки всех листов книги. read_only-режим: строки идут итератором,
+    лист целиком в память не грузится.
+    """
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportError("для XLSX-планов нужен openpyxl: pip install openpyxl")
+
+    wb = openpyxl.load_workbook(xlsx_path, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            STATS["sheets"] += 1
+            for values in ws.iter_rows(values_only=True):
+                yield [_cell_text(v) for v in values]
+    finally:
+        wb.close()
+
+def iter_xlsx_plan(xlsx_path: pathlib.Path, program: str) -> Iterator[Dict]:
+    """
+    Записи плана из XLSX — та же схема, что и у iter_pdf_plan.
+    В книге строка плана — это строка листа, переносов нет, поэтому
+    буфер не нужен: контекст обновляем по тексту строки, а курс берём
+    из ячеек так же, как из строк таблиц PDF.
+    """
+    current_semester: Optional[int] = None
+    current_type: str = "Не определено"
+    seen: set = set()
+
+    for cells in iter_xlsx_rows(xlsx_path):
+        line = clean(" ".join(c for c in cells if c))
+        if not line:
+            continue
+        STATS["lines"] += 1
+        current_semester, current_type = update_context(line, current_semester, current_type)
+        item = table_row_item(cells)
+        if not item:
+            continue
+        r = {
+            "program": program,
+            "semester": current_semester,
+            "type": current_type,
+            **item
+        }
+        if keep_row(r, seen):
+            STATS["rows"] += 1
+            yield r
+
+def parse_xlsx_plan(xlsx_path: pathlib.Path, program: str) -> List[Dict]:
+    return list(iter_xlsx_plan(xlsx_path, program))
+
+def iter_plan(path: pathlib.Path, program: str, page_jobs: int = 1) -> Iterator[Dict]:
+    """Выбор парсера по расширению файла."""
+    if path.suffix.lower() in XLSX_SUFFIXES:
+        return iter_xlsx_plan(path, program)
+    if path.suffix.lower() == ".pdf":
+        return iter_pdf_plan(path, program, page_jobs)
+    raise ValueError(f"неподдерживаемый формат плана: {path.name}")
+
+def parse_plan(path: pathlib.Path, program: str, page_jobs: int = 1) -> List[Dict]:
+    return list(iter_plan(path, program, page_jobs))
+
+
+# ---------------------------
+# Кэш разбора
+# ---------------------------
+
+@lru_cache(maxsize=None)
+def parser_fingerprint() -> str:
+    """
+    Отпечаток парсера: версия, регексы, ключевые слова и настройки таблиц.
+    Любая их правка инвалидирует кэш.
+    """
+    h = hashlib.sha256()
+    parts = [
+        str(PARSER_VERSION),
+        RE_SEMESTER_CTX.pattern, RE_POOL_ELECT.pattern,
+        RE_REQUIRED.pattern, RE_COURSE_LINE.pattern,
+        json.dumps(TABLE_SETTINGS, sort_keys=True),
+        # сюда же входят ключевые слова фильтров
+        json.dumps({k: v for k, v in SETTINGS.items() if k not in RUNTIME_SETTINGS},
+                   sort_keys=True),
+    ]
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()[:16]
+
+def file_sha256(path: pathlib.Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_entry(pdf_path: pathlib.Path, program: str, cache_dir: pathlib.Path) -> pathlib.Path:
+    """Файл кэша: ключ — SHA-256 файла, программа и отпечаток парсера."""
+    key = hashlib.sha256(
+        f"{file_sha256(pdf_path)}:{program}:{parser_fingerprint()}".encode("utf-8")
+    ).hexdigest()
+    return cache_dir / f"{key}.json"
+
+def read_cache(entry: pathlib.Path) -> Optional[List[Dict]]:
+    if entry.exists():
+        try:
+            return json.loads(entry.read_text("utf-8"))
+        except ValueError:
+            pass  # битая запись — перепарсим и перезапишем
+    return None
+
+def write_cache(entry: pathlib.Path, rows: List[Dict]):
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(rows, ensure_ascii=False), "utf-8")
+    tmp.replace(entry)
+
+def parse_plan_cached(pdf_path: pathlib.Path, program: str, page_jobs: int = 1,
+                      cache_dir: Optional[pathlib.Path] = CACHE_DIR) -> List[Dict]:
+    """
+    parse_plan с дисковым кэшем. При попадании pdfplumber не открывается
+    вовсе. cache_dir=None — кэш выключен.
+    """
+    if cache_dir is None:
+        return parse_plan(pdf_path, program, page_jobs)
+
+    entry = cache_entry(pdf_path, program, cache_dir)
+    rows = read_cache(entry)
+    if rows is None:
+        rows = parse_plan(pdf_path, program, page_jobs)
+        write_cache(entry, rows)
+    return rows
+
+def iter_plan_cached(pdf_path: pathlib.Path, program: str, page_jobs: int = 1,
+                     cache_dir: Optional[pathlib.Path] = CACHE_DIR) -> Iterator[Dict]:
+    """
+    Потоковый вариант parse_plan_cached: при промахе записи отдаются по
+    мере разбора (iter_plan), а копия копится для кэша и сохраняется,
+    только если генератор дочитан до конца.
+    """
+    if cache_dir is None:
+        yield from iter_plan(pdf_path, program, page_jobs)
+        return
+
+    entry = cache_entry(pdf_path, program, cache_dir)
+    cached = read_cache(entry)
+    if cached is not None:
+        yield from cached
+        return
+
+    rows: List[Dict] = []
+    for r in iter_plan(pdf_path, program, page_jobs):
+        rows.append(r)
+        yield r
+    write_cache(entry, rows)
+
+
+# ---------------------------
+# Выбор источника плана
+# ---------------------------
+
+def pdf_ruling_density(pdf_path: pathlib.Path) -> int:
+    """
+    Грубая оценка "табличности" PDF по первой странице: число рёбер
+    (page.edges, как в has_rulings). Чем больше, тем дороже extract_tables.
+    """
+    try:
+        with pdfplumber.open(pdf_path) as pdf:
+            if not pdf.pages:
+                return 0
+            page = pdf.pages[0]
+            return len(page.edges)
+    except Exception:
+        return 1 << 30
+
+def plan_cost(path: pathlib.Path) -> Tuple[int, int]:
+    """Ключ сортировки: XLSX < PDF с текстовым слоем < PDF с тяжёлыми таблицами."""
+    suffix = path.suffix.lower()
+    if suffix in XLSX_SUFFIXES:
+        return 0, 0
+    if suffix == ".pdf":
+        return 1, pdf_ruling_density(path)
+    return 2, 0
+
+def plan_candidates(item: Dict) -> List[pathlib.Path]:
+    """
+    Существующие файлы плана программы (item["files"] и/или item["file"]),
+    от самого дешёвого для разбора к самому дорогому.
+    """
+    paths: List[pathlib.Path] = []
+    for entry in [*item.get("files", []), {"file": item.get("file")}]:
+        if not entry.get("file"):
             continue
-        # отфильтровать общие заголовки, случайно попавшие
-        low = r["name"].lower()
-        if any(kw in low for kw in ["учебный план", "блок ", "семестр старт", "лист1"]):
+        p = pathlib.Path(entry["file"])
+        if p.exists() and p not in paths:
+            paths.append(p)
+    if len(paths) < 2:
+        return paths
+    return sorted(paths, key=plan_cost)
+
+def parse_program(files: List[pathlib.Path], program: str, page_jobs: int = 1,
+                  cache_dir: Optional[pathlib.Path] = None) -> List[Dict]:
+    """
+    Разбирает первый файл из files, который дал записи; при ошибке или
+    пустом результате переходит к следующему (более дорогому) формату.
+    MemoryError (--max-rss) и ImportError (нет openpyxl) не глушатся,
+    а если не разобрался ни один файл — RuntimeError: пустой результат
+    попал бы в манифест как «0 записей» и больше не перепарсивался бы.
+    """
+    failed = 0
+    for i, filep in enumerate(files):
+        nxt = f", пробую {files[i + 1].name}" if i + 1 < len(files) else ""
+        try:
+            rows = parse_plan_cached(filep, program, page_jobs, cache_dir)
+        except (MemoryError, ImportError):
+            raise
+        except Exception as e:
+            print(f"[WARN] {program}: {filep.name} не разобран ({e}){nxt}")
+            failed += 1
             continue
-        clean_res.append(r)
+        if rows:
+            return rows
+        print(f"[WARN] {program}: {filep.name} — 0 записей{nxt}")
+    if failed == len(files):
+        raise RuntimeError(f"{program}: не разобран ни один файл плана")
+    return []
+
+def stream_program(filep: pathlib.Path, program: str, page_jobs: int = 1,
+                   cache_dir: Optional[pathlib.Path] = None) -> Iterator[Dict]:
+    """
+    Единственный файл программы — записи по мере разбора (iter_plan_cached).
+    Перейти к другому формату после начала записи нельзя, поэтому сбой
+    разбора, как и в parse_program, становится RuntimeError.
+    """
+    try:
+        yield from iter_plan_cached(filep, program, page_jobs, cache_dir)
+    except (MemoryError, ImportError):
+        raise
+    except Exception as e:
+        raise RuntimeError(f"{program}: {filep.name} не разобран ({e})") from e
+
+
+# ---------------------------
+# Запись и чтение результата
+# ---------------------------
+
+@contextmanager
+def open_rows_writer(path: pathlib.Path, fmt: str = "json") -> Iterator[Callable[[Dict], None]]:
+    """
+    Отдаёт функцию write(row). Пишем во временный файл рядом и
+    переименовываем по успешному завершению, так что path всегда целый.
 
-    return clean_res
+    jsonl — каждая запись пишется (и сбрасывается на диск) сразу,
+    json  — записи копятся и сериализуются одним списком в конце.
+    """
+    tmp = path.with_name(path.name + ".tmp")
+    rows: List[Dict] = []
+    f = open(tmp, "w", encoding="utf-8")
+    try:
+        if fmt == "jsonl":
+            def write(row: Dict):
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                f.flush()
+        else:
+            write = rows.append
+        yield write
+        if fmt != "jsonl":
+            f.write(json.dumps(rows, ensure_ascii=False, indent=2))
+        f.close()
+        tmp.replace(path)
+    except BaseException:
+        f.close()
+        tmp.unlink(missing_ok=True)
+        raise
+
+def iter_courses(path: pathlib.Path = OUT_JSONL) -> Iterator[Dict]:
+    """Лениво читает записи из .jsonl (построчно) или из .json (целиком)."""
+    if path.suffix == ".jsonl":
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from json.loads(path.read_text("utf-8"))
+
+
+# ---------------------------
+# Инкрементальная пересборка
+# ---------------------------
+
+def load_manifest(path: pathlib.Path = MANIFEST) -> Dict[str, Dict]:
+    """
+    Манифест: что лежит в courses.json для каждой программы —
+    { program: {file, sha256, parser, rows} }.
+    """
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text("utf-8"))
+    except ValueError:
+        print(f"[WARN] битый манифест, полная пересборка: {path}")
+        return {}
+
+def save_manifest(manifest: Dict[str, Dict], path: pathlib.Path = MANIFEST):
+    path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), "utf-8")
+
+def group_rows_by_program(rows: Iterator[Dict]) -> Dict[str, List[Dict]]:
+    grouped: Dict[str, List[Dict]] = {}
+    for r in rows:
+        grouped.setdefault(r["program"], []).append(r)
+    return grouped
+
+def manifest_record(files: List[pathlib.Path], out_path: pathlib.Path) -> Dict:
+    """Запись манифеста для программы (без rows — его проставляют после разбора)."""
+    digests = [file_sha256(f) for f in files]
+    return {"files": [str(f) for f in files],
+            "sha256": digests[0] if len(digests) == 1
+                      else hashlib.sha256(":".join(digests).encode()).hexdigest(),
+            "parser": parser_fingerprint(), "out": str(out_path)}
+
+def manifest_unchanged(old: Optional[Dict], rec: Dict, prev: List[Dict]) -> bool:
+    """Можно ли взять прошлые записи программы вместо разбора."""
+    return bool(old) and {k: old.get(k) for k in rec} == rec and old.get("rows") == len(prev)
+
+
+# ---------------------------
+# SQLite-хранилище (--sqlite)
+# ---------------------------
+
+# courses — записи с индексами под типичные выборки (по программе,
+# по семестру и типу, по названию), courses_fts — полнотекстовый поиск
+# по названию, programs — что загружено по каждой программе (как в манифесте)
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS courses (
+    id       INTEGER PRIMARY KEY,
+    program  TEXT NOT NULL,
+    semester INTEGER,
+    type     TEXT,
+    name     TEXT NOT NULL,
+    ects     NUMERIC,
+    hours    NUMERIC
+);
+CREATE INDEX IF NOT EXISTS idx_courses_program  ON courses(program);
+CREATE INDEX IF NOT EXISTS idx_courses_semester ON courses(semester, type);
+CREATE INDEX IF NOT EXISTS idx_courses_type     ON courses(type);
+CREATE INDEX IF NOT EXISTS idx_courses_name     ON courses(name);
+CREATE TABLE IF NOT EXISTS programs (
+    program TEXT PRIMARY KEY,
+    sha256  TEXT,
+    parser  TEXT,
+    rows    INTEGER
+);
+"""
+
+SQLITE_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS courses_fts
+    USING fts5(name, content='courses', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS courses_ai AFTER INSERT ON courses BEGIN
+    INSERT INTO courses_fts(rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS courses_ad AFTER DELETE ON courses BEGIN
+    INSERT INTO courses_fts(courses_fts, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+"""
+
+COURSE_FIELDS = ("program", "semester", "type", "name", "ects", "hours")
+
+def open_store(path: pathlib.Path = OUT_DB) -> sqlite3.Connection:
+    """Открывает (и при необходимости создаёт) базу курсов."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(SQLITE_SCHEMA)
+    try:
+        conn.executescript(SQLITE_FTS)
+    except sqlite3.OperationalError as e:
+        # SQLite без FTS5: всё, кроме поиска по словам, работает
+        print(f"[WARN] FTS5 недоступен, полнотекстового поиска не будет ({e})")
+    return conn
+
+def has_fts(conn: sqlite3.Connection) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'courses_fts'").fetchone() is not None
+
+def store_programs(conn: sqlite3.Connection) -> Dict[str, Tuple[str, str]]:
+    """{program: (sha256, parser)} — что сейчас лежит в базе."""
+    return {p: (sha, parser) for p, sha, parser in
+            conn.execute("SELECT program, sha256, parser FROM programs")}
+
+def stale_programs(conn: sqlite3.Connection, manifest: Dict[str, Dict]) -> set:
+    """Программы манифеста, чьи записи в базе отсутствуют или устарели."""
+    stored = store_programs(conn)
+    return {p for p, rec in manifest.items()
+            if stored.get(p) != (rec["sha256"], rec["parser"])}
+
+def upsert_program(conn: sqlite3.Connection, program: str, rec: Dict, rows: List[Dict]):
+    """Заменяет все записи программы; вызывать внутри транзакции."""
+    conn.execute("DELETE FROM courses WHERE program = ?", (program,))
+    conn.executemany(
+        f"INSERT INTO courses ({', '.join(COURSE_FIELDS)}) VALUES ({', '.join('?' * len(COURSE_FIELDS))})",
+        ([r.get(k) for k in COURSE_FIELDS] for r in rows),
+    )
+    conn.execute(
+        "INSERT INTO programs (program, sha256, parser, rows) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(program) DO UPDATE SET sha256 = excluded.sha256, "
+        "parser = excluded.parser, rows = excluded.rows",
+        (program, rec["sha256"], rec["parser"], len(rows)),
+    )
+
+def sync_store(conn: sqlite3.Connection, manifest: Dict[str, Dict],
+               rows_by_program: Dict[str, List[Dict]]):
+    """
+    Одной транзакцией: перезаписывает программы из rows_by_program и
+    удаляет те, которых больше нет в манифесте.
+    """
+    with conn:
+        for program, rows in rows_by_program.items():
+            upsert_program(conn, program, manifest[program], rows)
+        for program in store_programs(conn):
+            if program not in manifest:
+                conn.execute("DELETE FROM courses WHERE program = ?", (program,))
+                conn.execute("DELETE FROM programs WHERE program = ?", (program,))
+
+def query_courses(conn: sqlite3.Connection, program: Optional[str] = None,
+                  semester: Optional[int] = None, ctype: Optional[str] = None,
+                  text: Optional[str] = None) -> List[Dict]:
+    """
+    Выборка по индексам: query_courses(conn, semester=2, ctype="Выборная").
+    text — запрос FTS5 по названию (при отсутствии FTS5 — подстрока).
+    """
+    where, params = [], []
+    for col, val in (("program", program), ("semester", semester), ("type", ctype)):
+        if val is not None:
+            where.append(f"c.{col} = ?")
+            params.append(val)
+    if text:
+        if has_fts(conn):
+            where.append("c.id IN (SELECT rowid FROM courses_fts WHERE courses_fts MATCH ?)")
+            params.append(text)
+        else:
+            where.append("c.name LIKE ?")
+            params.append(f"%{text}%")
+    sql = f"SELECT {', '.join('c.' + k for k in COURSE_FIELDS)} FROM courses c"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY c.id"
+    return [dict(zip(COURSE_FIELDS, row)) for row in conn.execute(sql, params)]
 
 
 # ---------------------------
 # Основной сценарий
 # ---------------------------
 
-def main():
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Парсер учебных планов из data/plan_files.json")
+    ap.add_argument("-j", "--jobs", type=int, default=1,
+                    help="число процессов для разбора планов (0 — по числу ядер)")
+    ap.add_argument("--page-jobs", type=int, default=1,
+                    help="число процессов для извлечения страниц внутри одного PDF")
+    ap.add_argument("--cache-dir", type=pathlib.Path, default=CACHE_DIR,
+                    help=f"каталог кэша разбора (по умолчанию {CACHE_DIR})")
+    ap.add_argument("--no-cache", action="store_true",
+                    help="не читать и не писать кэш разбора")
+    ap.add_argument("--incremental", action="store_true",
+                    help="перепарсить только добавленные/изменённые программы "
+                         f"по манифесту {MANIFEST.name}")
+    ap.add_argument("--format", choices=["json", "jsonl"], default="json",
+                    help=f"json — {OUT_JSON.name} одним списком; "
+                         f"jsonl — {OUT_JSONL.name}, запись по мере разбора")
+    ap.add_argument("--limit", type=int, default=None, metavar="N",
+                    help="предпросмотр: вывести первые N записей в stdout (jsonl) "
+                         "и остановиться, не трогая выходные файлы")
+    ap.add_argument("--table-min-rulings", type=int, default=SETTINGS["table_min_rulings"],
+                    metavar="N",
+                    help="искать таблицы только на страницах, где рёбер линеек (page.edges) "
+                         "не меньше N (0 — всегда)")
+    ap.add_argument("--engine", choices=["chars", "plumber"], default=SETTINGS["engine"],
+                    help="chars — один проход по символам страницы для текста и таблиц; "
+                         "plumber — extract_text()/extract_tables()")
+    ap.add_argument("--no-dedup", action="store_true",
+                    help="не схлопывать повторяющиеся записи внутри программы")
+    ap.add_argument("--keywords", type=pathlib.Path, default=None, metavar="JSON",
+                    help='ключевые слова фильтров из файла: {"noise": [...], "header": [...]}')
+    ap.add_argument("--low-memory", action="store_true",
+                    help="сбрасывать кэши pdfplumber после каждой страницы")
+    ap.add_argument("--max-rss", type=int, default=None, metavar="MB",
+                    help="прервать разбор, если RSS процесса превысит MB; "
+                         "печатает пиковый RSS по каждому файлу")
+    ap.add_argument("--metrics", type=pathlib.Path, nargs="?", const=METRICS_JSON,
+                    default=None, metavar="JSON",
+                    help="замерять время по стадиям: таблица в конце прогона "
+                         f"и JSON (по умолчанию {METRICS_JSON})")
+    ap.add_argument("--sqlite", type=pathlib.Path, nargs="?", const=OUT_DB,
+                    default=None, metavar="DB",
+                    help="дополнительно записать курсы в SQLite с индексами и FTS5 "
+                         f"(по умолчанию {OUT_DB}); обновляются только изменившиеся программы")
+    return ap.parse_args(argv)
+
+def iter_parsed(todo: List[Tuple[str, List[pathlib.Path]]], jobs: int, page_jobs: int = 1,
+                cache_dir: Optional[pathlib.Path] = None):
+    """
+    Разбирает планы и отдаёт (program, rows) строго в порядке todo.
+    При jobs > 1 программы раздаются по процессам ProcessPoolExecutor.
+    В последовательном режиме с единственным файлом rows — ленивый
+    stream_program (и при включённом кэше), его нужно дочитать до перехода
+    к следующей программе. С несколькими форматами и в пуле записи
+    программы приходят списком: выбор формата требует разобрать файл целиком.
+    """
+    if jobs == 1 or len(todo) < 2:
+        for program, files in todo:
+            print(f"[INFO] parse {program}: {files[0].name}")
+            if len(files) == 1:
+                yield program, stream_program(files[0], program, page_jobs, cache_dir)
+            else:
+                yield program, parse_program(files, program, page_jobs, cache_dir)
+        return
+
+    with make_pool(jobs) as ex:
+        futures = []
+        for program, files in todo:
+            print(f"[INFO] parse {program}: {files[0].name}")
+            futures.append(ex.submit(parse_in_worker, files, program, page_jobs, cache_dir))
+        # Собираем в исходном порядке индекса, а не по мере готовности
+        for (program, _), fut in zip(todo, futures):
+            rows, snap = fut.result()
+            merge_metrics(snap)
+            yield program, rows
+
+def parse_in_worker(files: List[pathlib.Path], program: str, page_jobs: int,
+                     cache_dir: Optional[pathlib.Path]) -> Tuple[List[Dict], Dict]:
+    """Задача пула: строки плана плюс замеры, набранные в процессе."""
+    reset_metrics()
+    rows = parse_program(files, program, page_jobs, cache_dir)
+    return rows, snapshot_metrics()
+
+def preview(idx: List[Dict], limit: int, page_jobs: int = 1):
+    """Печатает первые limit записей и прекращает разбор, не дочитывая PDF."""
+    shown = 0
+    for item in idx:
+        for filep in plan_candidates(item):
+            try:
+                for r in iter_plan(filep, item["program"], page_jobs):
+                    if shown >= limit:
+                        return
+                    print(json.dumps(r, ensure_ascii=False))
+                    shown += 1
+                break
+            except Exception as e:
+                # stdout занят записями — предупреждение в stderr
+                print(f"[WARN] {item['program']}: {filep.name} не разобран ({e})", file=sys.stderr)
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    configure(table_min_rulings=args.table_min_rulings, engine=args.engine,
+              dedup=not args.no_dedup, low_memory=args.low_memory,
+              max_rss_mb=args.max_rss, metrics=args.metrics is not None)
+    if args.keywords:
+        configure(**load_keywords(args.keywords))
+
+    t_start = time.perf_counter()
+    run(args, jobs)
+    if SETTINGS["metrics"]:
+        report = metrics_report(time.perf_counter() - t_start)
+        print_metrics(report)
+        args.metrics.write_text(json.dumps(report, ensure_ascii=False, indent=2), "utf-8")
+        print(f"Metrics -> {args.metrics}")
+
+def run(args: argparse.Namespace, jobs: int):
     if not PLAN_INDEX.exists():
         raise SystemExit("Нет data/plan_files.json. Сначала запусти загрузку PDF.")
 
     idx = json.loads(PLAN_INDEX.read_text("utf-8"))
-    all_rows: List[Dict] = []
 
+    if args.limit is not None:
+        preview(idx, args.limit, args.page_jobs)
+        return
+
+    out_path = OUT_JSONL if args.format == "jsonl" else OUT_JSON
+
+    old_manifest: Dict[str, Dict] = {}
+    prev_rows: Dict[str, List[Dict]] = {}
+    if args.incremental and out_path.exists():
+        old_manifest = load_manifest()
+        if old_manifest:
+            prev_rows = group_rows_by_program(iter_courses(out_path))
+
+    manifest: Dict[str, Dict] = {}
+    by_program: Dict[str, List[Dict]] = {}
+    todo: List[Tuple[str, List[pathlib.Path]]] = []
+    t_index = time.perf_counter()
     for item in idx:
         program = item["program"]
-        filep   = pathlib.Path(item["file"])
-        if not filep.exists():
-            print(f"[WARN] нет файла: {filep}")
+        files   = plan_candidates(item)
+        if not files:
+            print(f"[WARN] нет файла: {item.get('file') or [f['file'] for f in item.get('files', [])]}")
+            continue
+        rec = manifest_record(files, out_path)
+        old = old_manifest.get(program)
+        reuse = prev_rows.get(program, [])
+        if manifest_unchanged(old, rec, reuse):
+            print(f"[SKIP] {program}: без изменений ({len(reuse)} записей)")
+            by_program[program] = reuse
+            manifest[program] = old
             continue
-        print(f"[INFO] parse {program}: {filep.name}")
-        rows = parse_pdf_plan(filep, program)
-        all_rows.extend(rows)
-        print(f"[OK] {program}: извлечено {len(rows)} записей")
+        manifest[program] = rec
+        todo.append((program, files))
+    if SETTINGS["metrics"]:
+        add_timing("index", time.perf_counter() - t_index)
+
+    removed = [p for p in old_manifest if p not in manifest]
+    for program in removed:
+        print(f"[DEL] {program}: программы больше нет в индексе")
+
+    store = open_store(args.sqlite) if args.sqlite else None
+    stale = stale_programs(store, manifest) if store else set()
+
+    if args.incremental and old_manifest and not todo and not removed and not stale:
+        print(f"\n{out_path} актуален, перезапись не нужна")
+        if store:
+            sync_store(store, manifest, {})
+            store.close()
+        return
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    parsed = iter_parsed(todo, jobs, args.page_jobs, cache_dir)
+    total = 0
+    # Записи программ, которые нужно перезаписать в базе
+    to_store: Dict[str, List[Dict]] = {}
+    # Итог — в порядке индекса: переиспользованные программы вперемешку
+    # с только что разобранными (iter_parsed отдаёт их в том же порядке)
+    try:
+        with stage("parse+write"), open_rows_writer(out_path, args.format) as write:
+            if SETTINGS["metrics"]:
+                write = timed("write", write)
+            for program in manifest:
+                fresh = program not in by_program
+                rows = next(parsed)[1] if fresh else by_program[program]
+                n = 0
+                keep = to_store.setdefault(program, []) if program in stale else None
+                for r in rows:
+                    write(r)
+                    n += 1
+                    if keep is not None:
+                        keep.append(r)
+                if fresh:
+                    manifest[program]["rows"] = n
+                    print(f"[OK] {program}: извлечено {n} записей")
+                total += n
+    except (MemoryError, ImportError, RuntimeError) as e:
+        # Сработал --max-rss, нет openpyxl или программа не разобралась:
+        # выходной файл не тронут (пишется через tmp), манифест и база
+        # не обновляются
+        raise SystemExit(f"[ERR] {e}")
 
-    OUT_JSON.write_text(json.dumps(all_rows, ensure_ascii=False, indent=2), "utf-8")
-    print(f"\nSaved -> {OUT_JSON}  (всего {len(all_rows)} курсов)")
+    save_manifest(manifest)
+    print(f"\nSaved -> {out_path}  (всего {total} курсов)")
+    if store:
+        with stage("sqlite"):
+            sync_store(store, manifest, to_store)
+        store.close()
+        print(f"Saved -> {args.sqlite}  (обновлено программ: {len(to_store)})")
+    if STATS["pages"]:
+        print(f"[INFO] страниц разобрано: {STATS['pages']}, "
+              f"поиск таблиц пропущен: {STATS['tables_skipped']}, "
+              f"повторов схлопнуто: {STATS['duplicates']}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Скачивание и разбор учебных планов одним прогоном: каждый скачанный
+# план сразу уходит в очередь на разбор, пока остальные ещё качаются.
+#
+#   python pipeline.py                   # все программы каталога
+#   python pipeline.py -c 8 -j 4         # 8 страниц одновременно, 4 процесса разбора
+#   python pipeline.py --resume          # продолжить прерванный прогон
+
+import time
+import asyncio
+import pathlib
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+import courses_parse as cp
+import scrape_plan_files as spf
+
+# Сколько скачанных, но ещё не разобранных программ может ждать в очереди;
+# при заполнении скачивание приостанавливается
+QUEUE_SIZE = 8
+
+# ---------------------------
+# Разбор из очереди
+# ---------------------------
+
+async def parse_worker(queue: asyncio.Queue, ex, out_path: pathlib.Path,
+                       parsed: Dict[str, Tuple[Dict, List[Dict]]],
+                       old_manifest: Dict[str, Dict], prev_rows: Dict[str, List[Dict]],
+                       page_jobs: int, cache_dir: Optional[pathlib.Path],
+                       busy: List[float]):
+    """
+    Берёт записи plan_files.json из очереди и разбирает их в процессе
+    пула ex, не блокируя цикл событий — скачивание идёт дальше.
+    None в очереди — конец работы. Результат — parsed[program] = (rec, rows).
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        program = item["program"]
+        try:
+            files = cp.plan_candidates(item)
+            if not files:
+                print(f"[WARN] нет файла: {item.get('file') or [f['file'] for f in item.get('files', [])]}")
+                continue
+            rec = cp.manifest_record(files, out_path)
+            reuse = prev_rows.get(program, [])
+            if cp.manifest_unchanged(old_manifest.get(program), rec, reuse):
+                print(f"[SKIP] {program}: без изменений ({len(reuse)} записей)")
+                parsed[program] = (old_manifest[program], reuse)
+                continue
+
+            print(f"[INFO] parse {program}: {files[0].name}")
+            t = time.perf_counter()
+            rows, snap = await loop.run_in_executor(
+                ex, cp.parse_in_worker, files, program, page_jobs, cache_dir)
+            busy[0] += time.perf_counter() - t
+            cp.merge_metrics(snap)
+            rec["rows"] = len(rows)
+            parsed[program] = (rec, rows)
+            print(f"[OK] {program}: извлечено {len(rows)} записей")
+        except Exception as e:
+            # Сбой одной программы не должен останавливать очередь:
+            # иначе скачивание повиснет на заполненной очереди
+            print(f"[ERR] {program}: разбор не удался ({e})")
+
+async def run_pipeline(todo: List[tuple], ready: List[Dict], args: argparse.Namespace,
+                       known: Dict[str, Dict], cache: Dict[str, Dict], record,
+                       out_path: pathlib.Path, old_manifest: Dict[str, Dict],
+                       prev_rows: Dict[str, List[Dict]]) -> Dict[str, Tuple[Dict, List[Dict]]]:
+    """
+    Скачивает todo (scrape_all) и параллельно разбирает: каждая готовая
+    программа журналируется (record) и ставится в ограниченную очередь,
+    которую разбирают args.jobs обработчиков — по процессу пула на каждого.
+    ready — уже скачанные программы (--resume), они идут в очередь сразу.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, args.queue))
+    parsed: Dict[str, Tuple[Dict, List[Dict]]] = {}
+    busy = [0.0]
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    # Даже при -j 1 разбор идёт в отдельном процессе: в этом же процессе
+    # он занял бы цикл событий и остановил скачивание
+    with cp.make_pool(args.jobs, "spawn") as ex:
+        workers = [
+            asyncio.create_task(parse_worker(queue, ex, out_path, parsed, old_manifest,
+                                             prev_rows, args.page_jobs, cache_dir, busy))
+            for _ in range(args.jobs)
+        ]
+
+        async def on_result(item: Dict):
+            record(item)
+            await queue.put(item)
+
+        for item in ready:
+            await queue.put(item)
+
+        t = time.perf_counter()
+        await spf.scrape_all(todo, args.concurrency, known, cache, on_result)
+        t_scrape = time.perf_counter() - t
+
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    print(f"[TIME] скачивание {t_scrape:.2f}с, разбор {busy[0]:.2f}с (сумма по обработчикам)")
+    return parsed
+
+# ---------------------------
+# Основной сценарий
+# ---------------------------
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="Скачивание и разбор учебных планов одним прогоном")
+    ap.add_argument("-c", "--concurrency", type=int, default=spf.CONCURRENCY,
+                    help=f"страниц программ одновременно (по умолчанию {spf.CONCURRENCY})")
+    ap.add_argument("-j", "--jobs", type=int, default=2,
+                    help="процессов разбора (по умолчанию 2)")
+    ap.add_argument("--page-jobs", type=int, default=1,
+                    help="число процессов для извлечения страниц внутри одного PDF")
+    ap.add_argument("--queue", type=int, default=QUEUE_SIZE, metavar="N",
+                    help=f"программ в очереди на разбор (по умолчанию {QUEUE_SIZE})")
+    ap.add_argument("--format", choices=["json", "jsonl"], default="json",
+                    help=f"{cp.OUT_JSON.name} одним списком или {cp.OUT_JSONL.name}")
+    ap.add_argument("--cache-dir", type=pathlib.Path, default=cp.CACHE_DIR,
+                    help=f"каталог кэша разбора (по умолчанию {cp.CACHE_DIR})")
+    ap.add_argument("--no-cache", action="store_true",
+                    help="не читать и не писать кэш разбора")
+    ap.add_argument("--incremental", action="store_true",
+                    help="не разбирать программы, чьи файлы не изменились (по манифесту)")
+    ap.add_argument("--engine", choices=["chars", "plumber"], default=cp.SETTINGS["engine"])
+    ap.add_argument("--resume", action="store_true",
+                    help="не скачивать заново программы из журнала прерванного прогона")
+    ap.add_argument("--no-direct", action="store_true",
+                    help="не качать по известным URL из plan_files.json, всегда через браузер")
+    ap.add_argument("--no-discover", action="store_true",
+                    help="не обходить каталог, скачивать встроенный список программ")
+    ap.add_argument("--program", action="append", default=None, metavar="CODE",
+                    help="только эти программы (можно несколько)")
+    ap.add_argument("--browser-cdp", default=None, metavar="URL",
+                    help="подключаться к уже запущенному браузеру (scrape_plan_files.py --serve-browser)")
+    ap.add_argument("--sqlite", type=pathlib.Path, nargs="?", const=cp.OUT_DB,
+                    default=None, metavar="DB",
+                    help=f"дополнительно записать курсы в SQLite (по умолчанию {cp.OUT_DB})")
+    return ap.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    args.jobs = max(1, args.jobs)
+    spf.SETTINGS["browser_cdp"] = args.browser_cdp
+    cp.configure(engine=args.engine)
+
+    if args.no_discover:
+        pages = spf.PAGES
+    else:
+        pages = spf.resolve_pages(spf.LISTING_URL, args.concurrency, spf.LISTING_TTL_H)
+    if args.program:
+        pages = [(code, url) for code, url in pages if code in args.program]
+
+    out_path = cp.OUT_JSONL if args.format == "jsonl" else cp.OUT_JSON
+    # Прошлый результат нужен не только для --incremental: программы вне
+    # этого прогона (--program) и не разобравшиеся переносятся из него
+    old_manifest: Dict[str, Dict] = {}
+    prev_rows: Dict[str, List[Dict]] = {}
+    if out_path.exists():
+        old_manifest = cp.load_manifest()
+        prev_rows = cp.group_rows_by_program(cp.iter_courses(out_path))
+    reuse_manifest = old_manifest if args.incremental else {}
+
+    known = {} if args.no_direct else spf.load_known()
+    cache = spf.load_cache()
+    done = spf.load_journal() if args.resume else {}
+    ready = [done[code] for code, _ in pages if code in done]
+    todo = [(code, url) for code, url in pages if code not in done]
+
+    t_start = time.perf_counter()
+    with spf.JOURNAL.open("a" if args.resume else "w", encoding="utf-8") as jf:
+        parsed = asyncio.run(run_pipeline(todo, ready, args, known, cache, spf.journal_writer(jf),
+                                          out_path, reuse_manifest, prev_rows))
+    spf.save_cache(cache)
+    results = spf.write_index(pages, spf.load_journal(), merge=bool(args.program))
+
+    # Итог — в порядке индекса, как у courses_parse.py. Программы, которых
+    # нет в parsed (вне --program или разбор не удался), берутся из
+    # прошлого результата вместе с прежней записью манифеста
+    manifest: Dict[str, Dict] = {}
+    written: Dict[str, List[Dict]] = {}
+    total = 0
+    with cp.open_rows_writer(out_path, args.format) as write:
+        for program in spf.load_known():
+            if program in parsed:
+                rec, rows = parsed[program]
+            elif program in prev_rows:
+                rec, rows = old_manifest.get(program), prev_rows[program]
+            else:
+                continue
+            for r in rows:
+                write(r)
+            if rec:
+                manifest[program] = rec
+            written[program] = rows
+            total += len(rows)
+    cp.save_manifest(manifest)
+    if args.sqlite:
+        store = cp.open_store(args.sqlite)
+        stale = cp.stale_programs(store, manifest)
+        cp.sync_store(store, manifest, {p: written[p] for p in stale})
+        store.close()
+        print(f"Saved -> {args.sqlite}  (обновлено программ: {len(stale)})")
+
+    if len(results) < len(pages):
+        print(f"[WARN] не скачано программ: {len(pages) - len(results)} (повторите с --resume)")
+    print(f"[TIME] всего {time.perf_counter() - t_start:.2f}с")
+    print(f"\nSaved -> {spf.PLAN_INDEX}, {out_path}  (всего {total} курсов)")
+
+if __name__ == "__main__":
+    main()
@@ -4,74 +4,745 @@
 import pathlib
 import re
 import json
-from playwright.sync_api import sync_playwright
+import time
+import random
+import hashlib
+import asyncio
+import inspect
+import argparse
+from collections import Counter
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+from typing import Callable, Dict, List, Optional, Tuple
+
+from playwright.async_api import async_playwright
 
 OUT = pathlib.Path("data")
 OUT.mkdir(exist_ok=True, parents=True)
+PLAN_INDEX = OUT / "plan_files.json"
+# ETag/Last-Modified и хэш содержимого по URL скачанных планов
+PLAN_CACHE = OUT / "plan_cache.json"
+# Журнал прогона: по строке JSON на каждую готовую программу
+JOURNAL = OUT / "plan_files.journal.jsonl"
+
+# Каталог магистерских программ: отсюда берётся список программ
+LISTING_URL = "https://abit.itmo.ru/programs/master"
+PROGRAM_URL = "https://abit.itmo.ru/program/master/{code}"
+# Кэш найденного списка программ и сколько часов он считается свежим
+LISTING_CACHE = OUT / "programs.json"
+LISTING_TTL_H = 24.0
+# Предел страниц каталога на случай, если пагинация не заканчивается
+LISTING_MAX_PAGES = 50
 
+# Запасной список: если каталог недоступен и кэша нет, и для --no-discover
 PAGES = [
     ("ai", "https://abit.itmo.ru/program/master/ai"),
     ("ai_product", "https://abit.itmo.ru/program/master/ai_product"),
 ]
+RE_PROGRAM_LINK = re.compile(r"/program/master/([A-Za-z0-9_\-]+)")
+
+# Сколько страниц программ одновременно открыто в контексте браузера
+CONCURRENCY = 4
+
+# Настройки браузерного прохода (меняются из main по аргументам)
+SETTINGS: Dict = {
+    # Типы ресурсов, без которых кнопка «Скачать учебный план» всё равно
+    # появляется: картинки, шрифты, стили, медиа
+    "block_types": {"image", "media", "font", "stylesheet"},
+    # Домены (с поддоменами), запросы к которым пропускаем; всё прочее —
+    # аналитика, виджеты, CDN сторонних сервисов — обрывается.
+    # None — не фильтровать по домену.
+    "allowed_domains": ["itmo.ru", "itmo.su"],
+    # Выключатель всей перехватки запросов
+    "block": True,
+    # Адрес долгоживущего браузера (--serve-browser); None — запускать свой
+    "browser_cdp": None,
+    # Сколько контекстов держать в пуле на прогон
+    "contexts": 1,
+    # Таймауты стадий, мс: переход на страницу, ожидание кнопки, скачивание
+    # (для прямого HTTP — тоже "download")
+    "timeouts": {"navigation": 30000, "selector": 15000, "download": 15000},
+    # Повторов стадии после первой неудачи и параметры паузы между ними:
+    # случайная в [0, min(backoff_max, backoff * 2**n)] секунд
+    "retries": 2,
+    "backoff": 1.0,
+    "backoff_max": 10.0,
+}
+
+# Счётчики прогона и время готовности страницы по программам
+STATS: Counter = Counter()
+PAGE_TIMES: Dict[str, float] = {}
+# Повторы и окончательные отказы по стадиям
+RETRIES: Counter = Counter()
+FAILURES: Counter = Counter()
+
+# Конструктор ОП отдаёт план по адресу .../plan/abit/<формат>;
+# кнопка на странице качает PDF, остальные форматы пробуем по соседним URL.
+PLAN_FORMATS = ["pdf", "xlsx"]
+RE_PLAN_FORMAT_URL = re.compile(r"/plan/abit/(\w+)/?$")
+
+# ---------------------------
+# Кэш скачиваний (условный GET)
+# ---------------------------
+
+def load_cache(path: pathlib.Path = PLAN_CACHE) -> Dict[str, Dict]:
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text("utf-8"))
+    except ValueError:
+        return {}
+
+def save_cache(cache: Dict[str, Dict], path: pathlib.Path = PLAN_CACHE):
+    path.write_text(json.dumps(cache, ensure_ascii=False, indent=2), "utf-8")
 
-def main():
-    results = []
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        ctx = browser.new_context(accept_downloads=True)
+def file_sha256(path: pathlib.Path) -> Optional[str]:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except OSError:
+        return None
 
-        for code, url in PAGES:
+def remember(cache: Dict[str, Dict], url: str, filepath: pathlib.Path,
+             digest: str, headers: Optional[Dict] = None) -> bool:
+    """Обновляет запись кэша; True — содержимое отличается от прошлого."""
+    prev = cache.get(url, {})
+    headers = headers or {}
+    cache[url] = {
+        "file": str(filepath),
+        "sha256": digest,
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+    }
+    return prev.get("sha256") != digest or prev.get("file") != str(filepath)
+
+async def download(request, url: str, filepath: pathlib.Path,
+                   cache: Dict[str, Dict]) -> Optional[bool]:
+    """
+    Условный GET url -> filepath. True — файл изменился и перезаписан,
+    False — не изменился (304 или те же байты, файл не трогаем),
+    None — сервер не отдал план (ошибка или HTML).
+    """
+    headers = {}
+    rec = cache.get(url)
+    if rec and rec.get("file") == str(filepath) and filepath.exists():
+        if rec.get("etag"):
+            headers["If-None-Match"] = rec["etag"]
+        if rec.get("last_modified"):
+            headers["If-Modified-Since"] = rec["last_modified"]
+
+    resp = await request.get(url, headers=headers, timeout=SETTINGS["timeouts"]["download"])
+    if resp.status == 304:
+        return False
+    if not resp.ok or "html" in resp.headers.get("content-type", ""):
+        return None
+
+    body = await resp.body()
+    digest = hashlib.sha256(body).hexdigest()
+    if digest == file_sha256(filepath):
+        remember(cache, url, filepath, digest, resp.headers)
+        return False
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    tmp = filepath.with_name(filepath.name + ".tmp")
+    tmp.write_bytes(body)
+    tmp.replace(filepath)
+    remember(cache, url, filepath, digest, resp.headers)
+    return True
+
+async def fetch_other_formats(request, url: str, filepath: pathlib.Path,
+                              cache: Dict[str, Dict]) -> Tuple[list, bool]:
+    """
+    Скачивает остальные форматы плана рядом с filepath.
+    request — APIRequestContext (ctx.request браузера или отдельный HTTP-клиент).
+    Возвращает ([{format, url, file}] для тех, что реально отдались,
+    изменился ли хоть один из них).
+    """
+    m = RE_PLAN_FORMAT_URL.search(url or "")
+    if not m:
+        return [], False
+    files = []
+    changed = False
+    for fmt in PLAN_FORMATS:
+        if fmt == m.group(1).lower():
+            continue
+        furl = url[:m.start(1)] + fmt
+        fpath = filepath.with_suffix("." + fmt)
+        try:
+            got = await download(request, furl, fpath, cache)
+        except Exception as e:
+            print(f"[WARN] {furl}: {e}")
+            continue
+        # Нет такого формата — сервер отвечает ошибкой или HTML-страницей
+        if got is None:
+            continue
+        changed |= got
+        files.append({"format": fmt, "url": furl, "file": str(fpath)})
+    return files, changed
+
+# ---------------------------
+# Журнал прогона (--resume)
+# ---------------------------
+
+def load_journal(path: pathlib.Path = JOURNAL) -> Dict[str, Dict]:
+    """
+    Готовые программы из журнала; при повторе программы побеждает
+    последняя запись. Недописанная строка (падение посреди записи)
+    пропускается.
+    """
+    done: Dict[str, Dict] = {}
+    if not path.exists():
+        return done
+    with path.open(encoding="utf-8") as f:
+        for line in f:
             try:
-                page = ctx.new_page()
-                print(f"[INFO] Открываю страницу {code}...")
-                # Ждём только загрузки DOM
-                page.goto(url, wait_until="domcontentloaded", timeout=30000)
-
-                # Ждём появления кнопки
-                page.wait_for_selector("button:has-text('Скачать учебный план')", timeout=15000)
-
-                btn = page.get_by_role("button", name=re.compile(r"скачать.*учебн.*план", re.I))
-                if not btn.count():
-                    print(f"[WARN] Кнопка не найдена: {code}")
-                    page.close()
-                    continue
-
-                # Ловим download
-                with page.expect_download(timeout=15000) as d:
-                    btn.first.click()
-                dl = d.value
-                filepath = OUT / dl.suggested_filename
-                dl.save_as(filepath)
+                item = json.loads(line)
+                done[item["program"]] = item
+            except (ValueError, KeyError, TypeError):
+                continue
+    return done
 
-                try:
-                    url_src = dl.url
-                except Exception:
-                    url_src = ""
+def journal_writer(f) -> Callable[[Dict], None]:
+    """Дописывает результат программы в журнал сразу по готовности."""
+    # Недописанную при падении строку закрываем, чтобы не склеить с новой
+    if f.tell() and pathlib.Path(f.name).read_bytes()[-1:] != b"\n":
+        f.write("\n")
+
+    def record(item: Dict):
+        f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        f.flush()
+    return record
+
+def write_index(pages: List[tuple], done: Dict[str, Dict], path: pathlib.Path = PLAN_INDEX,
+                merge: bool = False) -> List[Dict]:
+    """
+    plan_files.json из журнала в порядке pages (через временный файл).
+    merge — прогон по части программ (--program): остальные записи
+    прежнего индекса сохраняются на своих местах (changed=False), новые
+    программы дописываются в конец. Возвращает записи этого прогона.
+    """
+    results = [done[code] for code, _ in pages if code in done]
+    index = results
+    if merge:
+        fresh = {r["program"]: r for r in results}
+        index = [fresh.pop(code, dict(item, changed=False))
+                 for code, item in load_known(path).items()]
+        index += fresh.values()
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(index, ensure_ascii=False, indent=2), "utf-8")
+    tmp.replace(path)
+    return results
+
+# ---------------------------
+# Повторы с экспоненциальной паузой
+# ---------------------------
+
+async def with_retries(stage: str, code: str, attempt_fn):
+    """
+    Выполняет стадию stage (navigation/selector/download) с повторами.
+    attempt_fn(n) — корутина-фабрика, n — номер попытки с 0.
+    Между попытками — пауза с «полным» джиттером, чтобы параллельные
+    страницы не повторяли запросы синхронно. После последней неудачи
+    исключение пробрасывается.
+    """
+    retries = max(0, SETTINGS["retries"])
+    for n in range(retries + 1):
+        try:
+            return await attempt_fn(n)
+        except Exception as e:
+            if n == retries:
+                FAILURES[stage] += 1
+                raise
+            delay = random.uniform(0, min(SETTINGS["backoff_max"], SETTINGS["backoff"] * 2 ** n))
+            RETRIES[stage] += 1
+            print(f"[WARN] {code}: {stage} не удалось ({type(e).__name__}), "
+                  f"повтор {n + 1}/{retries} через {delay:.1f}с")
+            await asyncio.sleep(delay)
+
+def print_retries():
+    if not RETRIES and not FAILURES:
+        return
+    stages = sorted(set(RETRIES) | set(FAILURES))
+    print("[INFO] повторы по стадиям: " +
+          ", ".join(f"{s} {RETRIES[s]} (отказов {FAILURES[s]})" for s in stages))
+
+# ---------------------------
+# Поиск программ в каталоге
+# ---------------------------
+
+def extract_programs(html: str) -> List[str]:
+    """Коды программ по ссылкам /program/master/<code>, в порядке появления."""
+    return list(dict.fromkeys(RE_PROGRAM_LINK.findall(html)))
+
+def listing_page_url(url: str, n: int) -> str:
+    if n == 1:
+        return url
+    return f"{url}{'&' if '?' in url else '?'}page={n}"
+
+async def fetch_listing_page(http, sem: asyncio.Semaphore, url: str, n: int) -> List[str]:
+    page_url = listing_page_url(url, n)
+
+    async def attempt(_n: int) -> str:
+        resp = await http.get(page_url, timeout=SETTINGS["timeouts"]["navigation"])
+        # За последней страницей каталог отвечает 404 — это не сбой
+        if resp.status == 404:
+            return ""
+        if not resp.ok:
+            raise RuntimeError(f"HTTP {resp.status}")
+        return await resp.text()
+
+    async with sem:
+        return extract_programs(await with_retries("listing", page_url, attempt))
+
+async def discover_programs(url: str = LISTING_URL, concurrency: int = CONCURRENCY,
+                            max_pages: int = LISTING_MAX_PAGES) -> List[tuple]:
+    """
+    Читает первую страницу каталога, затем остальные пачками по
+    concurrency параллельно, пока очередная пачка не перестанет давать
+    новые программы (или до max_pages). Сбой первой страницы —
+    исключение, сбой последующих — предупреждение.
+    Возвращает [(code, url)] в порядке каталога.
+    """
+    codes: Dict[str, None] = {}
+    sem = asyncio.Semaphore(max(1, concurrency))
+    async with async_playwright() as p:
+        http = await p.request.new_context()
+        try:
+            n = 1
+            while n <= max_pages:
+                # Первая страница — отдельно: если каталог не отвечает,
+                # не стоит сразу бить по остальным
+                size = 1 if n == 1 else max(1, concurrency)
+                batch = range(n, min(n + size, max_pages + 1))
+                found = await asyncio.gather(*(
+                    fetch_listing_page(http, sem, url, i) for i in batch
+                ), return_exceptions=n > 1)
+                before = len(codes)
+                for i, page_codes in zip(batch, found):
+                    if isinstance(page_codes, Exception):
+                        print(f"[WARN] страница каталога {i} пропущена: {str(page_codes).splitlines()[0]}")
+                        continue
+                    codes.update(dict.fromkeys(page_codes))
+                if len(codes) == before:
+                    break
+                n = batch.stop
+        finally:
+            await http.dispose()
+    return [(code, PROGRAM_URL.format(code=code)) for code in codes]
+
+def load_listing(path: pathlib.Path = LISTING_CACHE) -> Tuple[List[tuple], Optional[float]]:
+    """Список программ из кэша и его возраст в часах (None — кэша нет)."""
+    try:
+        data = json.loads(path.read_text("utf-8"))
+        pages = [(p["program"], p["url"]) for p in data["programs"]]
+        return pages, (time.time() - data["fetched_at"]) / 3600
+    except (OSError, ValueError, KeyError, TypeError):
+        return [], None
+
+def save_listing(pages: List[tuple], url: str, path: pathlib.Path = LISTING_CACHE):
+    data = {
+        "url": url,
+        "fetched_at": time.time(),
+        "programs": [{"program": code, "url": purl} for code, purl in pages],
+    }
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), "utf-8")
+
+def resolve_pages(url: str, concurrency: int, ttl_h: float, refresh: bool = False) -> List[tuple]:
+    """
+    Список программ для скачивания: свежий кэш, иначе обход каталога;
+    если каталог не отдал ни одной программы — устаревший кэш, а без
+    него — запасной PAGES.
+    """
+    cached, age = load_listing()
+    if cached and not refresh and age < ttl_h:
+        print(f"[INFO] программ в каталоге: {len(cached)} (кэш {age:.1f}ч)")
+        return cached
+
+    try:
+        pages = asyncio.run(discover_programs(url, concurrency))
+    except Exception as e:
+        print(f"[WARN] каталог программ недоступен: {str(e).splitlines()[0]}")
+        pages = []
+    if pages:
+        save_listing(pages, url)
+        print(f"[INFO] программ в каталоге: {len(pages)}")
+        return pages
+    if cached:
+        print(f"[WARN] каталог пуст, беру кэш возрастом {age:.1f}ч")
+        return cached
+    print("[WARN] каталог пуст, беру встроенный список программ")
+    return PAGES
+
+# ---------------------------
+# Быстрый путь: прямой HTTP по известному URL
+# ---------------------------
 
-                print(f"[OK] {code}: {filepath.name}")
-                results.append({
-                    "program": code,
-                    "url": url_src,
-                    "file": str(filepath)
-                })
+def load_known(path: pathlib.Path = PLAN_INDEX) -> Dict[str, Dict]:
+    """Записи прошлого plan_files.json по программам: там уже есть URL планов."""
+    if not path.exists():
+        return {}
+    try:
+        return {item["program"]: item for item in json.loads(path.read_text("utf-8"))}
+    except (ValueError, KeyError, TypeError):
+        return {}
 
-            except Exception as e:
-                print(f"[ERR] {code}: {e}")
+async def fetch_direct(http, sem: asyncio.Semaphore, code: str, known: Dict,
+                       cache: Dict[str, Dict]) -> Optional[Dict]:
+    """
+    Качает план по уже известному URL без рендера страницы.
+    None — URL неизвестен или не сработал, программу нужно пройти браузером.
+    """
+    url = known.get("url")
+    if not url or not known.get("file"):
+        return None
+    filepath = pathlib.Path(known["file"])
+    async with sem:
+        try:
+            changed = await download(http, url, filepath, cache)
+        except Exception as e:
+            print(f"[WARN] {code}: прямое скачивание не удалось ({e})")
+            return None
+        if changed is None:
+            print(f"[WARN] {code}: прямое скачивание не отдало план")
+            return None
 
-            finally:
+        files = [{"format": filepath.suffix.lstrip(".").lower(), "url": url, "file": str(filepath)}]
+        other, other_changed = await fetch_other_formats(http, url, filepath, cache)
+        files += other
+        changed |= other_changed
+
+    state = "обновлён" if changed else "без изменений"
+    print(f"[OK] {code}: {', '.join(pathlib.Path(f['file']).name for f in files)} (напрямую, {state})")
+    return {
+        "program": code,
+        "url": url,
+        "file": str(filepath),
+        "files": files,
+        "changed": changed
+    }
+
+# ---------------------------
+# Браузерный путь
+# ---------------------------
+
+def host_allowed(url: str, allowed: Optional[List[str]]) -> bool:
+    if allowed is None:
+        return True
+    host = (urlparse(url).hostname or "").lower()
+    return any(host == d or host.endswith("." + d) for d in allowed)
+
+async def install_blocking(ctx):
+    """
+    Перехват запросов контекста: обрываем ненужные типы ресурсов и
+    сторонние домены (SETTINGS), считаем пропущенные/оборванные.
+    """
+    block_types = SETTINGS["block_types"]
+    allowed = SETTINGS["allowed_domains"]
+
+    async def handler(route):
+        req = route.request
+        if req.resource_type in block_types or not host_allowed(req.url, allowed):
+            STATS["requests_blocked"] += 1
+            await route.abort()
+        else:
+            STATS["requests_allowed"] += 1
+            await route.continue_()
+
+    await ctx.route("**/*", handler)
+
+class ContextPool:
+    """
+    Пул готовых контекстов браузера (downloads разрешены, перехват
+    запросов установлен). scrape_program берёт контекст в аренду —
+    наименее загруженный — и возвращает по завершении.
+    """
+
+    def __init__(self, browser, size: int = 1):
+        self.browser = browser
+        self.size = max(1, size)
+        self._active: Dict[object, int] = {}
+
+    async def start(self):
+        while len(self._active) < self.size:
+            ctx = await self.browser.new_context(accept_downloads=True)
+            if SETTINGS["block"]:
+                await install_blocking(ctx)
+            self._active[ctx] = 0
+
+    @asynccontextmanager
+    async def lease(self):
+        ctx = min(self._active, key=self._active.get)
+        self._active[ctx] += 1
+        try:
+            yield ctx
+        finally:
+            self._active[ctx] -= 1
+
+    async def close(self):
+        for ctx in self._active:
+            try:
+                await ctx.close()
+            except Exception:
+                pass
+        self._active.clear()
+
+async def open_browser(p):
+    """
+    Подключается к долгоживущему браузеру (SETTINGS["browser_cdp"]) —
+    тогда запуск Chromium не нужен, — либо запускает свой.
+    """
+    cdp = SETTINGS["browser_cdp"]
+    if cdp:
+        try:
+            browser = await p.chromium.connect_over_cdp(cdp)
+            print(f"[INFO] Подключился к браузеру {cdp}")
+            return browser
+        except Exception as e:
+            print(f"[WARN] браузер {cdp} недоступен ({e}), запускаю свой")
+    return await p.chromium.launch(headless=True)
+
+async def serve_browser(port: int):
+    """
+    Долгоживущий Chromium с CDP на port для повторных прогонов
+    (--browser-cdp http://127.0.0.1:<port>). Работает до Ctrl+C.
+    """
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(
+            headless=True, args=[f"--remote-debugging-port={port}"]
+        )
+        print(f"[INFO] Браузер готов: --browser-cdp http://127.0.0.1:{port}  (Ctrl+C — остановить)")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await browser.close()
+
+async def scrape_program(pool: ContextPool, sem: asyncio.Semaphore, code: str, url: str,
+                         cache: Dict[str, Dict]) -> Optional[Dict]:
+    """Открывает страницу программы и скачивает план. None — не получилось."""
+    timeouts = SETTINGS["timeouts"]
+    async with sem, pool.lease() as ctx:
+        page = None
+        stage = "navigation"
+        try:
+            page = await ctx.new_page()
+            print(f"[INFO] Открываю страницу {code}...")
+            t0 = time.perf_counter()
+            # Ждём только загрузки DOM
+            await with_retries(stage, code, lambda n: page.goto(
+                url, wait_until="domcontentloaded", timeout=timeouts["navigation"]))
+
+            # Ждём появления кнопки; повтор — с перезагрузкой страницы
+            async def wait_button(n: int):
+                if n:
+                    await page.reload(wait_until="domcontentloaded", timeout=timeouts["navigation"])
+                await page.wait_for_selector("button:has-text('Скачать учебный план')",
+                                             timeout=timeouts["selector"])
+            stage = "selector"
+            await with_retries(stage, code, wait_button)
+            PAGE_TIMES[code] = time.perf_counter() - t0
+
+            btn = page.get_by_role("button", name=re.compile(r"скачать.*учебн.*план", re.I))
+            if not await btn.count():
+                print(f"[WARN] Кнопка не найдена: {code}")
+                return None
+
+            # Ловим download
+            async def click_download(n: int):
+                async with page.expect_download(timeout=timeouts["download"]) as d:
+                    await btn.first.click()
+                return await d.value
+            stage = "download"
+            dl = await with_retries(stage, code, click_download)
+            filepath = OUT / dl.suggested_filename
+            # Через браузер условный GET невозможен: сохраняем рядом и
+            # подменяем файл, только если байты отличаются
+            tmp = filepath.with_name(filepath.name + ".tmp")
+            await dl.save_as(tmp)
+            digest = file_sha256(tmp)
+            if digest == file_sha256(filepath):
+                tmp.unlink()
+            else:
+                tmp.replace(filepath)
+
+            try:
+                url_src = dl.url
+            except Exception:
+                url_src = ""
+            changed = remember(cache, url_src or str(filepath), filepath, digest)
+
+            files = [{"format": filepath.suffix.lstrip(".").lower(),
+                      "url": url_src, "file": str(filepath)}]
+            other, other_changed = await fetch_other_formats(ctx.request, url_src, filepath, cache)
+            files += other
+            changed |= other_changed
+
+            state = "обновлён" if changed else "без изменений"
+            print(f"[OK] {code}: {', '.join(pathlib.Path(f['file']).name for f in files)} ({state})")
+            # file/url — основной (скачанный кнопкой) файл, files — все форматы,
+            # changed — изменился ли хоть один файл с прошлого прогона
+            return {
+                "program": code,
+                "url": url_src,
+                "file": str(filepath),
+                "files": files,
+                "changed": changed
+            }
+
+        except Exception as e:
+            print(f"[ERR] {code}: {stage}: {e}")
+            return None
+
+        finally:
+            if page is not None:
                 try:
-                    page.close()
+                    await page.close()
                 except Exception:
                     pass
 
-        ctx.close()
-        browser.close()
+async def _reported(coro, on_result: Optional[Callable]):
+    r = await coro
+    if r and on_result:
+        res = on_result(r)
+        if inspect.isawaitable(res):
+            await res
+    return r
+
+async def scrape_all(pages: List[tuple], concurrency: int = CONCURRENCY,
+                     known: Optional[Dict[str, Dict]] = None,
+                     cache: Optional[Dict[str, Dict]] = None,
+                     on_result: Optional[Callable] = None) -> List[Dict]:
+    """
+    Сначала программы с известным URL плана (known) качаются напрямую
+    общим HTTP-клиентом с пулом соединений; браузер запускается только
+    для остальных и для тех, где прямой путь не сработал (или берётся
+    долгоживущий, см. open_browser). Браузерные программы идут параллельно
+    в контекстах из ContextPool, не больше concurrency страниц
+    одновременно. Порядок результата — как в pages.
+    cache — ETag/хэши скачиваний (см. download), дополняется на месте.
+    on_result вызывается с каждой готовой программой сразу по готовности;
+    если это корутинная функция, её результат дожидается (так pipeline.py
+    придерживает скачивание, пока очередь на разбор заполнена).
+    """
+    known = known or {}
+    cache = {} if cache is None else cache
+    sem = asyncio.Semaphore(max(1, concurrency))
+    async with async_playwright() as p:
+        http = await p.request.new_context()
+        found = await asyncio.gather(*(
+            _reported(fetch_direct(http, sem, code, known.get(code, {}), cache), on_result)
+            for code, _ in pages
+        ))
+        await http.dispose()
+
+        rest = [i for i, r in enumerate(found) if r is None]
+        if rest:
+            browser = await open_browser(p)
+            pool = ContextPool(browser, SETTINGS["contexts"])
+            await pool.start()
+
+            scraped = await asyncio.gather(*(
+                _reported(scrape_program(pool, sem, *pages[i], cache), on_result) for i in rest
+            ))
+            for i, r in zip(rest, scraped):
+                found[i] = r
+
+            await pool.close()
+            # Для подключённого по CDP браузера это только отключение:
+            # сам процесс остаётся жить для следующих прогонов
+            await browser.close()
+    return [r for r in found if r]
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Скачивание учебных планов магистерских программ ИТМО")
+    ap.add_argument("-c", "--concurrency", type=int, default=CONCURRENCY,
+                    help=f"страниц программ одновременно (по умолчанию {CONCURRENCY})")
+    ap.add_argument("--no-direct", action="store_true",
+                    help="не качать по известным URL из plan_files.json, всегда через браузер")
+    ap.add_argument("--no-block", action="store_true",
+                    help="не обрывать запросы картинок/шрифтов/стилей и сторонних доменов")
+    ap.add_argument("--block-types", default=",".join(sorted(SETTINGS["block_types"])),
+                    help="обрываемые типы ресурсов через запятую (image,font,stylesheet,media,...)")
+    ap.add_argument("--allow-domain", action="append", default=None, metavar="DOMAIN",
+                    help="разрешённый домен (можно несколько; по умолчанию "
+                         f"{', '.join(SETTINGS['allowed_domains'])}); '*' — любой")
+    ap.add_argument("--serve-browser", type=int, default=None, metavar="PORT",
+                    help="запустить долгоживущий Chromium с CDP на PORT и ждать (без скачивания)")
+    ap.add_argument("--browser-cdp", default=None, metavar="URL",
+                    help="подключаться к уже запущенному браузеру (http://127.0.0.1:PORT)")
+    ap.add_argument("--contexts", type=int, default=SETTINGS["contexts"],
+                    help="контекстов браузера в пуле")
+    ap.add_argument("--retries", type=int, default=SETTINGS["retries"],
+                    help="повторов каждой стадии после неудачи (0 — без повторов)")
+    ap.add_argument("--backoff", type=float, default=SETTINGS["backoff"], metavar="SEC",
+                    help="базовая пауза перед повтором, удваивается с каждой попыткой")
+    for name in SETTINGS["timeouts"]:
+        ap.add_argument(f"--timeout-{name}", type=int, default=SETTINGS["timeouts"][name], metavar="MS",
+                        help=f"таймаут стадии {name}, мс")
+    ap.add_argument("--resume", action="store_true",
+                    help=f"продолжить прерванный прогон: пропустить программы, уже записанные в {JOURNAL}")
+    ap.add_argument("--no-discover", action="store_true",
+                    help="не обходить каталог, скачивать встроенный список программ")
+    ap.add_argument("--listing-url", default=LISTING_URL, help="URL каталога программ")
+    ap.add_argument("--listing-ttl", type=float, default=LISTING_TTL_H, metavar="HOURS",
+                    help=f"сколько часов кэш каталога {LISTING_CACHE} считается свежим")
+    ap.add_argument("--refresh-listing", action="store_true",
+                    help="обойти каталог заново, даже если кэш свежий")
+    ap.add_argument("--program", action="append", default=None, metavar="CODE",
+                    help="скачивать только эти программы (можно несколько)")
+    args = ap.parse_args(argv)
+
+    if args.serve_browser:
+        try:
+            asyncio.run(serve_browser(args.serve_browser))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    SETTINGS["retries"] = args.retries
+    SETTINGS["backoff"] = args.backoff
+    for name in SETTINGS["timeouts"]:
+        SETTINGS["timeouts"][name] = getattr(args, f"timeout_{name}")
+    SETTINGS["browser_cdp"] = args.browser_cdp
+    SETTINGS["contexts"] = args.contexts
+    SETTINGS["block"] = not args.no_block
+    SETTINGS["block_types"] = {t.strip() for t in args.block_types.split(",") if t.strip()}
+    if args.allow_domain:
+        SETTINGS["allowed_domains"] = None if "*" in args.allow_domain else args.allow_domain
+
+    if args.no_discover:
+        pages = PAGES
+    else:
+        pages = resolve_pages(args.listing_url, args.concurrency, args.listing_ttl, args.refresh_listing)
+    if args.program:
+        pages = [(code, url) for code, url in pages if code in args.program]
+
+    known = {} if args.no_direct else load_known()
+    cache = load_cache()
+
+    # Без --resume журнал начинается заново; с ним — готовые программы
+    # пропускаются, новые дописываются в конец
+    done = load_journal() if args.resume else {}
+    todo = [(code, url) for code, url in pages if code not in done]
+    for code, _ in pages:
+        if code in done:
+            print(f"[SKIP] {code}: уже в журнале")
+    with JOURNAL.open("a" if args.resume else "w", encoding="utf-8") as jf:
+        asyncio.run(scrape_all(todo, args.concurrency, known, cache, journal_writer(jf)))
+    save_cache(cache)
 
-    (OUT / "plan_files.json").write_text(
-        json.dumps(results, ensure_ascii=False, indent=2),
-        "utf-8"
-    )
-    print(f"Saved: {OUT/'plan_files.json'}")
+    results = write_index(pages, load_journal(), merge=bool(args.program))
+    n_changed = sum(1 for r in results if r.get("changed"))
+    print(f"[INFO] изменилось программ: {n_changed} из {len(results)}")
+    if len(results) < len(pages):
+        print(f"[WARN] не скачано программ: {len(pages) - len(results)} (повторите с --resume)")
+    if PAGE_TIMES:
+        avg = sum(PAGE_TIMES.values()) / len(PAGE_TIMES)
+        print("[TIME] готовность страницы: " +
+              ", ".join(f"{c} {t:.2f}с" for c, t in PAGE_TIMES.items()) +
+              f" (в среднем {avg:.2f}с)")
+    if STATS["requests_blocked"] or STATS["requests_allowed"]:
+        print(f"[INFO] запросов оборвано: {STATS['requests_blocked']}, "
+              f"пропущено: {STATS['requests_allowed']}")
+    print_retries()
+    print(f"Saved: {PLAN_INDEX}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()